@@ -0,0 +1,151 @@
+"""Скользящие счётчики аномалий для команд бота /top, /stats и /recent.
+
+Каждое окно — кольцо корзин фиксированного размера, поэтому память не
+растёт со временем работы: старая корзина очищается, когда кольцо
+доходит до неё снова.
+"""
+import time
+from collections import Counter, OrderedDict, deque
+
+# Окно -> (длительность, секунды; число корзин)
+WINDOWS = {
+    "1m": (60, 60),
+    "1h": (3600, 60),
+    "24h": (86400, 24),
+}
+# Ключ для событий сверх предела ключей в корзине
+OTHER = "другие"
+
+
+class RollingCounter:
+    """Счётчик ключей за последние ``window`` секунд на кольце из ``slots`` корзин"""
+
+    def __init__(self, window, slots, max_keys=1000):
+        self.window = window
+        self.width = window / slots
+        self.max_keys = max_keys
+        self._buckets = [Counter() for _ in range(slots)]
+        self._starts = [None] * slots
+
+    def add(self, key, count=1, now=None):
+        now = time.time() if now is None else now
+        index = int(now // self.width)
+        slot = index % len(self._buckets)
+        bucket = self._buckets[slot]
+        if self._starts[slot] != index:
+            self._starts[slot] = index
+            bucket.clear()
+        if key not in bucket and len(bucket) >= self.max_keys:
+            key = OTHER
+        bucket[key] += count
+
+    def totals(self, now=None):
+        """Сумма по корзинам, попадающим в окно"""
+        now = time.time() if now is None else now
+        current = int(now // self.width)
+        total = Counter()
+        for start, bucket in zip(self._starts, self._buckets):
+            if start is not None and current - start < len(self._buckets):
+                total.update(bucket)
+        return total
+
+
+class AnomalyStats:
+    """Счётчики аномалий по (отпечаток, пользователь, причина) и запросов по
+    пользователям за окна WINDOWS, плюс последние срабатывания"""
+
+    def __init__(self, recent_size=20, max_keys=1000, examples_size=1000):
+        self.anomalies = {
+            name: RollingCounter(window, slots, max_keys)
+            for name, (window, slots) in WINDOWS.items()
+        }
+        self.queries = {
+            name: RollingCounter(window, slots, max_keys)
+            for name, (window, slots) in WINDOWS.items()
+        }
+        self._recent = deque(maxlen=recent_size)
+        # Пример текста для отпечатка: LRU, чтобы не держать все запросы
+        self._examples = OrderedDict()
+        self.examples_size = examples_size
+
+    def record(self, records, verdicts, now=None):
+        """Учёт обработанной страницы записей"""
+        now = time.time() if now is None else now
+        users = Counter(record.get('user', '') for record in records)
+        for counter in self.queries.values():
+            for user, count in users.items():
+                counter.add(user, count, now)
+
+        for record, verdict in zip(records, verdicts):
+            if not verdict.reason:
+                continue
+            user = record.get('user', '')
+            key = (verdict.fingerprint, user, verdict.reason)
+            for counter in self.anomalies.values():
+                counter.add(key, 1, now)
+            self._recent.append({
+                "timestamp": record.get('@timestamp'),
+                "user": user,
+                "database": record.get('database', ''),
+                "reason": verdict.reason,
+                "query": record.get('query', '')[:200],
+            })
+            self._examples[verdict.fingerprint] = record.get('query', '')[:200]
+            self._examples.move_to_end(verdict.fingerprint)
+            if len(self._examples) > self.examples_size:
+                self._examples.popitem(last=False)
+
+    def top(self, window="1h", limit=10, now=None):
+        """Самые частые аномальные отпечатки за окно"""
+        totals = self._totals(self.anomalies, window, now)
+        by_fingerprint = {}
+        for key, count in totals.items():
+            fingerprint, user, reason = key if key != OTHER else (OTHER, "", "")
+            entry = by_fingerprint.setdefault(fingerprint, {
+                "fingerprint": fingerprint,
+                "count": 0,
+                "users": Counter(),
+                "reasons": Counter(),
+                "query": self._examples.get(fingerprint, ""),
+            })
+            entry["count"] += count
+            if key != OTHER:
+                entry["users"][user] += count
+                entry["reasons"][reason] += count
+        top = sorted(by_fingerprint.values(), key=lambda entry: -entry["count"])[:limit]
+        for entry in top:
+            entry["users"] = dict(entry["users"].most_common(3))
+            entry["reasons"] = dict(entry["reasons"].most_common())
+        return top
+
+    def user_stats(self, user, now=None):
+        """Запросы и аномалии пользователя по всем окнам"""
+        stats = {}
+        for window in WINDOWS:
+            reasons = Counter()
+            fingerprints = Counter()
+            for key, count in self._totals(self.anomalies, window, now).items():
+                if key != OTHER and key[1] == user:
+                    fingerprints[key[0]] += count
+                    reasons[key[2]] += count
+            stats[window] = {
+                "queries": self._totals(self.queries, window, now).get(user, 0),
+                "anomalies": sum(reasons.values()),
+                "reasons": dict(reasons.most_common()),
+                "top": [
+                    {"fingerprint": fingerprint, "count": count,
+                     "query": self._examples.get(fingerprint, "")}
+                    for fingerprint, count in fingerprints.most_common(3)
+                ],
+            }
+        return stats
+
+    def recent(self, limit=None):
+        """Последние срабатывания, новые первыми"""
+        return list(self._recent)[::-1][:limit]
+
+    @staticmethod
+    def _totals(counters, window, now):
+        if window not in counters:
+            raise ValueError(f"неизвестное окно {window}, доступны: {', '.join(WINDOWS)}")
+        return counters[window].totals(now)
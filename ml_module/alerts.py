@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import STAGE_SECONDS
+from status import RateMeter
+
+logger = logging.getLogger(__name__)
+
+# Предел длины одного сообщения Telegram с запасом на заголовок дайджеста
+MESSAGE_LIMIT = 4096
+DIGEST_LIMIT = MESSAGE_LIMIT - 64
+DIGEST_SEPARATOR = "\n\n"
+
+
+def format_alert(source, verdict):
+    """Текст оповещения по записи лога и вердикту"""
+    query_text = source.get('query', '')
+    return (
+        f"Обнаружена аномалия!\n"
+        f"Время: {source['@timestamp']}\n"
+        f"Пользователь: {source.get('user', 'N/A')}\n"
+        f"Запрос: {query_text[:300]}...\n"
+        f"Причина: {verdict.reason}"
+    )
+
+
+class TokenBucket:
+    """Ограничение частоты отправки: rate_per_minute сообщений, всплеск до capacity"""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AlertQueue:
+    """Ограниченная очередь оповещений с отдельной задачей отправки.
+
+    Детектор только кладёт сообщения в очередь и не ждёт Telegram.
+    Отправитель склеивает накопившиеся сообщения в дайджесты, соблюдает
+    лимит частоты и повторяет отправку с экспоненциальной задержкой.
+    """
+
+    def __init__(self, bot, chat_id, maxsize=10000, rate_per_minute=20, burst=3,
+                 max_retries=5, retry_delay=1.0, error_window=900):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.bucket = TokenBucket(rate_per_minute, burst)
+        self.dropped = 0
+        # Потери за последние error_window секунд для /status
+        self.recent_drops = RateMeter(error_window)
+        self.sent = 0
+        self.maxsize = maxsize
+        # Очередь создаётся внутри запущенного цикла событий: до Python 3.10
+        # asyncio.Queue привязывается к циклу при создании, а AlertQueue
+        # строится ещё при импорте main.py, до asyncio.run()
+        self._queue = None
+        self._task = None
+
+    def put(self, message):
+        """Постановка сообщения в очередь без ожидания; при переполнении оно теряется"""
+        try:
+            self._get_queue().put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self.recent_drops.add()
+
+    def qsize(self):
+        """Число сообщений, ожидающих отправки"""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def start(self):
+        """Запуск задачи отправки"""
+        if self._task is None:
+            self._get_queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Остановка задачи отправки"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _get_queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        return self._queue
+
+    async def _run(self):
+        pending = None
+        while True:
+            if pending is None:
+                pending = await self._queue.get()
+            messages = [pending]
+            pending = None
+            await self.bucket.acquire()
+
+            # Всё, что накопилось за время ожидания, уходит одним дайджестом
+            length = len(messages[0])
+            while not self._queue.empty():
+                message = self._queue.get_nowait()
+                length += len(DIGEST_SEPARATOR) + len(message)
+                if length > DIGEST_LIMIT:
+                    pending = message
+                    break
+                messages.append(message)
+
+            text = DIGEST_SEPARATOR.join(messages)
+            if len(messages) > 1:
+                text = f"Оповещений: {len(messages)}\n\n{text}"
+            await self._send(text[:MESSAGE_LIMIT])
+
+    async def _send(self, text):
+        """Отправка с повторами; RetryAfter от Telegram задаёт паузу"""
+        for attempt in range(self.max_retries):
+            try:
+                started = time.perf_counter()
+                await self.bot.send_message(chat_id=self.chat_id, text=text)
+                STAGE_SECONDS.labels("alert_send").observe(time.perf_counter() - started)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Лимит Telegram, пауза {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                delay = self.retry_delay * 2 ** attempt
+                logger.error(f"Ошибка отправки сообщения: {e}, повтор через {delay} с")
+                await asyncio.sleep(delay)
+        self.dropped += 1
+        self.recent_drops.add()
+        logger.error("Оповещение не отправлено после всех попыток")
+
+
+class AlertDeduplicator:
+    """Подавление повторов оповещения в пределах окна.
+
+    Первое срабатывание по ключу (отпечаток, пользователь, причина) уходит
+    сразу, повторы в течение ``window`` секунд только считаются. Счётчик
+    дописывается к следующему оповещению по ключу или к итогу из flush.
+    """
+
+    def __init__(self, window=300, maxsize=100000):
+        self.window = window
+        self.maxsize = maxsize
+        self.suppressed = 0
+        # Ключ -> [начало окна, число повторов, текст первого оповещения];
+        # порядок вставки совпадает с порядком начала окон
+        self._entries = OrderedDict()
+
+    def admit(self, key, message, now=None):
+        """Текст для отправки или None, если оповещение подавлено"""
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[0] < self.window:
+            entry[1] += 1
+            self.suppressed += 1
+            return None
+
+        repeats = 0
+        if entry is not None:
+            repeats = entry[1]
+            del self._entries[key]
+        self._entries[key] = [now, 0, message]
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return self._with_counter(message, repeats) if repeats else message
+
+    def flush(self, now=None):
+        """Итоги закрытых окон, в которых были подавленные повторы"""
+        now = time.monotonic() if now is None else now
+        summaries = []
+        while self._entries:
+            key, (start, repeats, message) = next(iter(self._entries.items()))
+            if now - start < self.window:
+                break
+            del self._entries[key]
+            if repeats:
+                summaries.append(self._with_counter(message, repeats))
+        return summaries
+
+    def _with_counter(self, message, repeats):
+        count = f"{repeats:,}".replace(",", " ")
+        window = f"{self.window // 60} мин" if self.window % 60 == 0 else f"{self.window} с"
+        return f"{message}\nПовторов за последние {window}: {count}"
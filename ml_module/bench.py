@@ -0,0 +1,274 @@
+"""Бенчмарки горячего пути детектора.
+
+Запуск:
+    python bench.py rules --sizes 1000 10000 100000
+    python bench.py stages --size 100000 --recorded postgresql.log --json base.json
+    python bench.py stages --size 100000 --baseline base.json
+
+Всё считается офлайн: Elasticsearch и Telegram не нужны, модель обучается
+на синтетическом OLTP-потоке с фиксированным seed.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from detector import Detector, new_model
+from features import FEATURE_MODES, FeatureSpace
+from forest import compile_forest
+from query_cache import VerdictCache
+from replay import read_records
+from rules import DANGEROUS_PATTERNS, match_rule
+from sql_lexer import tokenize
+
+OLTP_TEMPLATES = [
+    "SELECT id, name, email FROM users WHERE id = {n}",
+    "UPDATE accounts SET balance = balance - {n} WHERE id = {m}",
+    "INSERT INTO orders (user_id, total) VALUES ({n}, {m})",
+    "SELECT o.id, o.total FROM orders o JOIN users u ON u.id = o.user_id "
+    "WHERE u.id = {n} AND o.status = 'paid' ORDER BY o.created_at DESC LIMIT 20",
+    "DELETE FROM sessions WHERE expires_at < now() - interval '{n} minutes'",
+]
+# Длинные запросы ORM: много колонок, JOIN и списки IN
+ORM_TEMPLATES = [
+    'SELECT "shop_order"."id", "shop_order"."user_id", "shop_order"."status", '
+    '"shop_order"."total", "shop_order"."created_at", "shop_order"."updated_at", '
+    '"auth_user"."id", "auth_user"."username", "auth_user"."email", '
+    '"auth_user"."is_active", "auth_user"."date_joined" FROM "shop_order" '
+    'INNER JOIN "auth_user" ON ("shop_order"."user_id" = "auth_user"."id") '
+    'WHERE ("shop_order"."status" IN ({ids}) AND "auth_user"."id" = {n}) '
+    'ORDER BY "shop_order"."created_at" DESC LIMIT 21',
+    "select order0_.id as id1_3_0_, item1_.id as id1_2_1_, order0_.customer_id as "
+    "customer5_3_0_, order0_.created as created2_3_0_, order0_.state as state3_3_0_, "
+    "item1_.order_id as order_id4_2_1_, item1_.price as price2_2_1_, item1_.qty as "
+    "qty3_2_1_ from orders order0_ left outer join order_items item1_ on "
+    "order0_.id=item1_.order_id left outer join customers customer2_ on "
+    "order0_.customer_id=customer2_.id where order0_.customer_id={n} and "
+    "order0_.state in ({ids}) order by order0_.created desc",
+    'UPDATE "catalog_product" SET "price" = {n}, "stock" = {m}, '
+    '"updated_at" = \'2024-05-01T12:00:00\'::timestamp WHERE "catalog_product"."id" IN ({ids})',
+    'INSERT INTO "audit_event" ("actor_id", "action", "object_type", "object_id", '
+    '"payload", "created_at") VALUES ({n}, \'update\', \'order\', {m}, '
+    '\'{{"fields": ["status", "total"], "source": "api"}}\', now()) RETURNING "audit_event"."id"',
+]
+MALICIOUS_TEMPLATES = [
+    "SELECT * FROM users WHERE login = 'admin' OR 1=1; --",
+    "SELECT name FROM products WHERE id = {n} UNION SELECT password FROM users",
+    "DROP DATABASE mydb",
+    "TRUNCATE TABLE audit_log",
+]
+CORPORA = {
+    "oltp": OLTP_TEMPLATES,
+    "orm": ORM_TEMPLATES,
+    "malicious": MALICIOUS_TEMPLATES,
+}
+STAGES = ("lex", "features", "rules", "model", "compiled", "detector")
+# Стадии, которые работают с пачкой целиком: задержка меряется на пачку
+BATCH_STAGES = ("features", "model", "compiled", "detector")
+
+
+def _fill(template, rnd):
+    n, m = rnd.randint(1, 100000), rnd.randint(1, 100000)
+    ids = ""
+    if "{ids}" in template:
+        ids = ", ".join(str(rnd.randint(1, 100000)) for _ in range(rnd.randint(1, 20)))
+    return template.format(n=n, m=m, ids=ids)
+
+
+def synthetic_corpus(size, malicious_share=0.01, seed=42):
+    """Синтетический поток запросов с небольшой долей атак"""
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        templates = MALICIOUS_TEMPLATES if rnd.random() < malicious_share else OLTP_TEMPLATES
+        corpus.append(_fill(rnd.choice(templates), rnd))
+    return corpus
+
+
+def template_corpus(templates, size, seed=42):
+    """Поток запросов одного вида"""
+    rnd = random.Random(seed)
+    return [_fill(rnd.choice(templates), rnd) for _ in range(size)]
+
+
+def recorded_corpus(path):
+    """Запросы из записанной нагрузки: postgresql.log или NDJSON-выгрузка"""
+    return [record["query"] for record in read_records(path)]
+
+
+def legacy_rule_loop(text):
+    """Прежняя проверка: re.search по каждому шаблону"""
+    for pattern in DANGEROUS_PATTERNS.values():
+        if re.search(pattern, text):
+            return pattern
+    return None
+
+
+def _timed(func, texts):
+    start = time.perf_counter()
+    hits = sum(1 for text in texts if func(text))
+    return time.perf_counter() - start, hits
+
+
+def bench_rules(sizes):
+    """Сравнение цикла по правилам и объединённого выражения"""
+    print(f"{'queries':>8} {'loop, s':>9} {'combined, s':>12} {'speedup':>8} {'hits':>6}")
+    for size in sizes:
+        texts = [tokenize(q).text for q in synthetic_corpus(size)]
+        loop_time, loop_hits = _timed(legacy_rule_loop, texts)
+        combined_time, combined_hits = _timed(match_rule, texts)
+        assert loop_hits == combined_hits
+        print(f"{size:>8} {loop_time:>9.3f} {combined_time:>12.3f} "
+              f"{loop_time / combined_time:>7.1f}x {combined_hits:>6}")
+
+
+def _peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _batches(items, batch):
+    return [items[i:i + batch] for i in range(0, len(items), batch)]
+
+
+def _run_stage(stage, queries, model, space, batch):
+    """Замер одной стадии в отдельном процессе, чтобы пик RSS был её собственным.
+
+    Вход стадии готовится до замера: признаки считаются по готовым токенам,
+    модель — по готовой матрице признаков. model — лес sklearn, compiled —
+    тот же лес в виде CompiledForest, как его использует детектор. Признаки
+    строятся в пространстве ``space``.
+    """
+    if stage in ("compiled", "detector"):
+        model = compile_forest(model)
+    tokens = None
+    if stage in ("features", "rules", "model", "compiled"):
+        tokens = [tokenize(q) for q in queries]
+    X = space.transform(tokens) if stage in ("model", "compiled") else None
+    detector = None
+    if stage == "detector":
+        detector = Detector(VerdictCache())
+        detector.set_model(model, space.metadata())
+    rss_before = _peak_rss_mb()
+
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    if stage == "lex":
+        for query in queries:
+            t = clock()
+            tokenize(query)
+            latencies.append(clock() - t)
+    elif stage == "rules":
+        for item in tokens:
+            t = clock()
+            match_rule(item.text)
+            latencies.append(clock() - t)
+    elif stage == "features":
+        for chunk in _batches(tokens, batch):
+            t = clock()
+            space.transform(chunk)
+            latencies.append(clock() - t)
+    elif stage in ("model", "compiled"):
+        for i in range(0, len(X), batch):
+            t = clock()
+            model.decision_function(X[i:i + batch])
+            latencies.append(clock() - t)
+    elif stage == "detector":
+        for chunk in _batches(queries, batch):
+            t = clock()
+            detector.score(chunk)
+            latencies.append(clock() - t)
+    elapsed = clock() - start
+
+    latencies = np.array(latencies) * 1000
+    rss_peak = _peak_rss_mb()
+    return {
+        "qps": len(queries) / elapsed if elapsed else 0.0,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "rss_mb": rss_peak,
+        "rss_growth_mb": rss_peak - rss_before,
+    }
+
+
+def bench_stages(corpora, stages, model, space, batch, baseline=None):
+    """Пропускная способность, задержки и пик памяти по стадиям для каждого корпуса"""
+    results = {}
+    for name, queries in corpora.items():
+        print(f"\n{name}: {len(queries)} запросов, пачка {batch}")
+        print(f"{'stage':<9} {'qps':>10} {'p50, ms':>9} {'p99, ms':>9} {'per':>6} "
+              f"{'RSS, MB':>8} {'+RSS, MB':>9} {'vs base':>8}")
+        results[name] = {}
+        for stage in stages:
+            # Свежий процесс на каждую стадию: пики памяти не смешиваются
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                row = pool.submit(_run_stage, stage, queries, model, space, batch).result()
+            results[name][stage] = row
+
+            base = (baseline or {}).get(name, {}).get(stage)
+            versus = f"{row['qps'] / base['qps']:>7.2f}x" if base and base["qps"] else f"{'-':>8}"
+            per = "batch" if stage in BATCH_STAGES else "query"
+            print(f"{stage:<9} {row['qps']:>10.0f} {row['p50_ms']:>9.3f} {row['p99_ms']:>9.3f} "
+                  f"{per:>6} {row['rss_mb']:>8.1f} {row['rss_growth_mb']:>9.1f} {versus}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rules_parser = subparsers.add_parser("rules", help="правила: цикл против автомата")
+    rules_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+
+    stages_parser = subparsers.add_parser(
+        "stages", help="стадии: lex, features, rules, model, compiled, detector"
+    )
+    stages_parser.add_argument("--size", type=int, default=100000,
+                               help="запросов в каждом синтетическом корпусе")
+    stages_parser.add_argument("--corpus", nargs="+", choices=list(CORPORA) + ["mixed"],
+                               default=list(CORPORA) + ["mixed"])
+    stages_parser.add_argument("--recorded", nargs="*", default=[],
+                               help="postgresql.log или NDJSON с полем query")
+    stages_parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    stages_parser.add_argument("--batch", type=int, default=1000)
+    stages_parser.add_argument("--feature-mode", choices=FEATURE_MODES, default="basic")
+    stages_parser.add_argument("--hash-width", type=int, default=64)
+    stages_parser.add_argument("--train-size", type=int, default=20000)
+    stages_parser.add_argument("--seed", type=int, default=42)
+    stages_parser.add_argument("--json", help="сохранить результаты для сравнения")
+    stages_parser.add_argument("--baseline", help="результаты прошлого запуска (--json)")
+    args = parser.parse_args()
+
+    if args.command == "rules":
+        bench_rules(args.sizes)
+    elif args.command == "stages":
+        corpora = {}
+        for name in args.corpus:
+            if name == "mixed":
+                corpora[name] = synthetic_corpus(args.size, seed=args.seed)
+            else:
+                corpora[name] = template_corpus(CORPORA[name], args.size, seed=args.seed)
+        for path in args.recorded:
+            corpora[os.path.basename(path)] = recorded_corpus(path)
+
+        space = FeatureSpace(args.feature_mode, args.hash_width)
+        training = template_corpus(OLTP_TEMPLATES, args.train_size, seed=args.seed + 1)
+        model = new_model().fit(space.transform_queries(training))
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        results = bench_stages(corpora, args.stages, model, space, args.batch, baseline)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,19 @@
-from aiogram import Dispatcher, types
+from aiogram import Dispatcher, F, types
 from aiogram import Bot
 import os
 import asyncio
-from aiogram.filters import Command
+import time
+from aiogram.filters import Command, CommandObject
+
+from status import query_status
+
+# Сокет, через который main.py отдаёт своё состояние
+STATUS_SOCKET = os.getenv("STATUS_SOCKET", "/tmp/ml_monitor.sock")
+# Отставание обработки от времени записей, после которого статус — предупреждение
+STATUS_LAG_WARNING = float(os.getenv("STATUS_LAG_WARNING", "300"))
+# Ответы команд мониторинга содержат тексты запросов, поэтому они отвечают
+# только в чате оповещений; без TELEGRAM_CHAT_ID — никому
+MONITOR_CHAT = F.chat.id == int(os.getenv("TELEGRAM_CHAT_ID") or 0)
 
 bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
 dp = Dispatcher()
@@ -12,12 +23,112 @@ async def cmd_start(message: types.Message):
     await message.answer(
         "🔒 Система мониторинга SQL-запросов\n\n"
         "Я буду уведомлять вас о подозрительных и опасных запросах к базе данных.\n"
-        "Используйте /status для проверки состояния системы."
+        "Используйте /status для проверки состояния системы.\n"
+        "/top [1m|1h|24h] — частые аномальные запросы\n"
+        "/stats <пользователь> — запросы и аномалии пользователя\n"
+        "/recent — последние срабатывания"
     )
 
-@dp.message(Command("status"))
+def format_status(status):
+    """Текст ответа /status по сводке мониторинга"""
+    lag = status["ingest_lag"]
+    # Состояние определяют только недавние ошибки; итоги с запуска справочно
+    recent = {name: count for name, count in status["recent_errors"].items() if count}
+    errors = {name: count for name, count in status["errors"].items() if count}
+    healthy = not recent and (lag is None or lag < STATUS_LAG_WARNING)
+    if status["last_processed_at"] is None:
+        processed_ago = "записей ещё не было"
+    else:
+        processed_ago = f"{time.time() - status['last_processed_at']:.0f} с назад"
+    lines = [
+        "✅ Система мониторинга работает нормально" if healthy
+        else "⚠️ Система мониторинга работает с отклонениями",
+        "",
+        f"Последняя запись: {status['last_timestamp'] or '—'} ({processed_ago})",
+        f"Отставание: {'—' if lag is None else f'{lag:.0f} с'}",
+        f"Скорость: {status['throughput']:.0f} запросов/с",
+        f"Обработано: {status['processed']}, аномалий: {status['anomalies']}",
+        f"Очереди: конвейер {status['pipeline_backlog']}, оповещения {status['alert_queue']}",
+        f"Модель: {status['model_version'] or 'не обучена'}, разделов: {status['partitions']}",
+        f"Ошибки за {status['error_window'] / 60:.0f} мин: {format_counts(recent) or 'нет'}",
+        f"Ошибки с запуска: {format_counts(errors) or 'нет'}",
+        f"Работает: {status['uptime'] / 3600:.1f} ч",
+    ]
+    return "\n".join(lines)
+
+async def ask_monitor(message, command):
+    """Запрос к мониторингу; при ошибке пользователь получает ответ, результат — None"""
+    try:
+        response = await query_status(STATUS_SOCKET, command)
+    except Exception:
+        await message.answer("❌ Модуль мониторинга не отвечает")
+        return None
+    if isinstance(response, dict) and "error" in response:
+        await message.answer(f"❌ {response['error']}")
+        return None
+    return response
+
+@dp.message(Command("status"), MONITOR_CHAT)
 async def cmd_status(message: types.Message):
-    await message.answer("✅ Система мониторинга работает нормально")
+    status = await ask_monitor(message, "status")
+    if status is not None:
+        await message.answer(format_status(status))
+
+def format_counts(counts):
+    return ", ".join(f"{name} {count}" for name, count in counts.items())
+
+@dp.message(Command("top"), MONITOR_CHAT)
+async def cmd_top(message: types.Message, command: CommandObject):
+    window = (command.args or "1h").strip()
+    top = await ask_monitor(message, f"top {window}")
+    if top is None:
+        return
+    if not top:
+        await message.answer(f"За {window} аномалий не было")
+        return
+    lines = [f"🔝 Частые аномалии за {window}:"]
+    for i, entry in enumerate(top, 1):
+        lines.append(
+            f"\n{i}. {entry['count']} раз — {format_counts(entry['reasons'])}\n"
+            f"Пользователи: {format_counts(entry['users'])}\n"
+            f"{entry['query'][:150]}"
+        )
+    await message.answer("\n".join(lines)[:4096])
+
+@dp.message(Command("stats"), MONITOR_CHAT)
+async def cmd_stats(message: types.Message, command: CommandObject):
+    if not command.args:
+        await message.answer("Использование: /stats <пользователь>")
+        return
+    user = command.args.strip()
+    stats = await ask_monitor(message, f"stats {user}")
+    if stats is None:
+        return
+    lines = [f"📊 Пользователь {user}:"]
+    for window, entry in stats.items():
+        line = f"\n{window}: запросов {entry['queries']}, аномалий {entry['anomalies']}"
+        if entry["reasons"]:
+            line += f" ({format_counts(entry['reasons'])})"
+        lines.append(line)
+        for top in entry["top"]:
+            lines.append(f"  {top['count']} — {top['query'][:100]}")
+    await message.answer("\n".join(lines)[:4096])
+
+@dp.message(Command("recent"), MONITOR_CHAT)
+async def cmd_recent(message: types.Message):
+    recent = await ask_monitor(message, "recent")
+    if recent is None:
+        return
+    if not recent:
+        await message.answer("Срабатываний пока не было")
+        return
+    lines = ["🕒 Последние срабатывания:"]
+    for entry in recent:
+        lines.append(
+            f"\n{entry['timestamp']} {entry['user']}@{entry['database']} — {entry['reason']}\n"
+            f"{entry['query'][:150]}"
+        )
+    await message.answer("\n".join(lines)[:4096])
 
 async def main():
     await dp.start_polling(bot)
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sklearn.ensemble import IsolationForest
+
+from features import FeatureSpace
+from forest import compile_forest
+from metrics import observe_stages
+from model_store import load_partition
+from query_cache import VerdictCache
+from rules import match_rule
+from sql_lexer import fingerprint, normalize, tokenize
+
+logger = logging.getLogger(__name__)
+
+ML_ANOMALY = "ML-аномалия"
+
+# Вердикт по запросу: причина (None, если запрос чистый), оценка модели, отпечаток
+Verdict = namedtuple("Verdict", "reason score fingerprint")
+
+
+def new_model():
+    """Необученная модель с параметрами по умолчанию"""
+    return IsolationForest(
+        n_estimators=100,
+        contamination=0.01,
+        random_state=42
+    )
+
+
+def fit_models(queries, partitions, min_samples, compiled=True, space=None):
+    """Глобальная модель и модели разделов (пользователь, база), в которых
+    не меньше ``min_samples`` записей. Признаки строятся один раз в
+    пространстве ``space`` (по умолчанию базовом).
+
+    При ``compiled`` леса sklearn заменяются на CompiledForest с тем же
+    decision_function: оценка быстрее, файл модели меньше.
+    """
+    finish = compile_forest if compiled else (lambda model: model)
+    X = (space or FeatureSpace()).transform_queries(queries)
+    model = finish(new_model().fit(X))
+
+    rows = {}
+    for i, key in enumerate(partitions):
+        rows.setdefault(key, []).append(i)
+    partition_models = {
+        key: finish(new_model().fit(X[indices]))
+        for key, indices in rows.items()
+        if len(indices) >= min_samples
+    }
+    return model, partition_models
+
+
+class PartitionModels:
+    """Модели разделов (пользователь, база): на диске все, в памяти — LRU"""
+
+    def __init__(self, directory=None, index=None, maxsize=32):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._files = {tuple(key): name for name, key in (index or {}).items()}
+        self._loaded = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, key):
+        """Модель раздела; при ошибке загрузки None, и раздел оценивает глобальная"""
+        model = self._loaded.get(key)
+        if model is not None:
+            self._loaded.move_to_end(key)
+            return model
+        try:
+            model = load_partition(os.path.join(self.directory, self._files[key]))
+        except Exception as e:
+            logger.error(f"Не удалось загрузить модель раздела {key}: {e}")
+            return None
+        self._loaded[key] = model
+        if len(self._loaded) > self.maxsize:
+            self._loaded.popitem(last=False)
+        return model
+
+
+class Detector:
+    """Проверка пачек запросов правилами и моделью"""
+
+    def __init__(self, cache, model=None, partition_cache_size=32):
+        self.cache = cache
+        self.model = model
+        self.model_info = {}
+        self.features = FeatureSpace()
+        self.partition_cache_size = partition_cache_size
+        self.partitions = PartitionModels(maxsize=partition_cache_size)
+
+    def set_model(self, model, metadata=None):
+        """Замена модели одним присваиванием; вердикты старой модели сбрасываются.
+
+        Модели разделов описаны в метаданных (``partitions_dir`` и индекс
+        ``partitions``) и подгружаются с диска по мере надобности. Признаки
+        строятся в пространстве, записанном в метаданных модели.
+        """
+        metadata = metadata or {}
+        self.features = FeatureSpace.from_metadata(metadata)
+        self.partitions = PartitionModels(
+            metadata.get("partitions_dir"),
+            metadata.get("partitions"),
+            maxsize=self.partition_cache_size
+        )
+        self.model = model
+        self.model_info = metadata
+        self.cache.clear()
+
+    def score(self, queries, partitions=None, timings=None):
+        """Вердикты для пачки запросов: список Verdict в том же порядке.
+
+        ``partitions`` — ключи (пользователь, база) для каждого запроса.
+        Запросы без срабатывания правил группируются по разделам, и каждая
+        группа оценивается своей моделью одним вызовом decision_function;
+        разделы без своей модели оценивает глобальная. Одинаковые отпечатки
+        внутри пачки считаются один раз. В ``timings``, если передан,
+        записываются длительности стадий rules, features и model.
+        """
+        started = time.perf_counter()
+        verdicts = [None] * len(queries)
+        pending = {}
+        for i, query in enumerate(queries):
+            query = query or ""
+            normalized = normalize(query)
+            query_fingerprint = fingerprint(normalized)
+            partition = None
+            if partitions is not None and partitions[i] in self.partitions:
+                partition = partitions[i]
+            key = query_fingerprint if partition is None else (partition, query_fingerprint)
+            if key in pending:
+                pending[key][2].append(i)
+                continue
+            cached = self.cache.get(key)
+            if cached is None:
+                # Разбор на лексемы нужен только при промахе кэша
+                tokens = tokenize(query, normalized)
+                rule = match_rule(tokens.text)
+                if rule is None:
+                    pending[key] = (partition, tokens, [i])
+                    continue
+                cached = Verdict(rule, None, query_fingerprint)
+                self.cache.put(key, cached)
+            verdicts[i] = cached
+
+        stage_times = {"rules": time.perf_counter() - started, "features": 0.0, "model": 0.0}
+        groups = {}
+        for key, (partition, tokens, indices) in pending.items():
+            groups.setdefault(partition, []).append((key, tokens, indices))
+        for partition, items in groups.items():
+            scores = self._decision_function(
+                partition, [tokens for _, tokens, _ in items], stage_times
+            )
+            for (key, _, indices), score in zip(items, scores):
+                reason = ML_ANOMALY if score is not None and score < 0 else None
+                verdict = Verdict(reason, score, key if partition is None else key[1])
+                self.cache.put(key, verdict)
+                for i in indices:
+                    verdicts[i] = verdict
+
+        if timings is not None:
+            timings.update(stage_times)
+        return verdicts
+
+    async def score_async(self, queries, partitions=None):
+        """score для конвейера: выполняется прямо в цикле событий"""
+        timings = {}
+        verdicts = self.score(queries, partitions, timings)
+        observe_stages(timings)
+        return verdicts
+
+    def _decision_function(self, partition, token_batch, stage_times):
+        """Оценки модели раздела для пачки; без обученной модели оценок нет"""
+        model = self.model
+        if partition is not None:
+            partition_model = self.partitions.get(partition)
+            if partition_model is not None:
+                model = partition_model
+        if model is None:
+            return [None] * len(token_batch)
+        started = time.perf_counter()
+        X = self.features.transform(token_batch)
+        featured = time.perf_counter()
+        scores = model.decision_function(X).tolist()
+        stage_times["features"] += featured - started
+        stage_times["model"] += time.perf_counter() - featured
+        return scores
+
+
+# Детектор внутри рабочего процесса пула: своя копия модели, правил и кэша
+_worker_detector = None
+
+
+def _init_worker(model, metadata, cache_size, cache_ttl, partition_cache_size):
+    global _worker_detector
+    _worker_detector = Detector(
+        VerdictCache(maxsize=cache_size, ttl=cache_ttl),
+        partition_cache_size=partition_cache_size
+    )
+    _worker_detector.set_model(model, metadata)
+
+
+def _score_in_worker(queries, partitions):
+    timings = {}
+    verdicts = _worker_detector.score(queries, partitions, timings)
+    return verdicts, timings
+
+
+class ProcessPoolScorer:
+    """Оценка пачек в пуле процессов, чтобы задействовать все ядра.
+
+    Каждый процесс держит копию текущей модели детектора и свой кэш
+    вердиктов. При замене модели пул пересоздаётся, старый завершается
+    после обработки уже отправленных пачек. Пул, потерявший процесс
+    (например, убитый OOM killer), тоже пересоздаётся.
+    """
+
+    def __init__(self, detector, processes):
+        self.detector = detector
+        self.processes = processes
+        self._executor = None
+        self._model = None
+
+    def _pool(self):
+        model = self.detector.model
+        if self._executor is None or self._model is not model:
+            old = self._executor
+            cache = self.detector.cache
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=_init_worker,
+                initargs=(
+                    model, self.detector.model_info, cache.maxsize, cache.ttl,
+                    self.detector.partition_cache_size
+                ),
+            )
+            self._model = model
+            if old is not None:
+                old.shutdown(wait=False)
+        return self._executor
+
+    async def score(self, queries, partitions=None):
+        """Вердикты для пачки из рабочего процесса; при сломанном пуле пачка
+        повторяется один раз в новом пуле"""
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        try:
+            verdicts, timings = await loop.run_in_executor(
+                pool, _score_in_worker, queries, partitions
+            )
+        except BrokenProcessPool:
+            logger.error("Рабочий процесс пула оценки завершился аварийно, пул пересоздаётся")
+            # Пул мог уже пересоздать другой оценщик, поймавший ту же ошибку
+            if self._executor is pool:
+                pool.shutdown(wait=False)
+                self._executor = None
+            verdicts, timings = await loop.run_in_executor(
+                self._pool(), _score_in_worker, queries, partitions
+            )
+        # Метрики рабочих процессов учитываются в основном процессе
+        observe_stages(timings)
+        return verdicts
+
+    def close(self):
+        """Завершение пула"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
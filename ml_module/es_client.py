@@ -0,0 +1,75 @@
+"""Настройка клиента Elasticsearch для мониторинга"""
+import logging
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+class OrjsonSerializer(JSONSerializer):
+    """JSON-сериализатор транспорта на orjson: разбор ответов поиска в
+    несколько раз быстрее стандартного json. Нестандартные типы
+    (даты, numpy, pandas) обрабатывает default из JSONSerializer."""
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        try:
+            # Транспорт отправляет bytes как есть, без повторного кодирования
+            return orjson.dumps(
+                data, default=self.default,
+                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            )
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+def make_serializer():
+    """orjson, если он установлен, иначе стандартный сериализатор клиента"""
+    if orjson is None:
+        logger.info("orjson не установлен, ответы Elasticsearch разбираются модулем json")
+        return JSONSerializer()
+    return OrjsonSerializer()
+
+
+def make_es_client(host, port=9200, maxsize=25, http_compress=True, timeout=30,
+                   max_retries=3, retry_on_timeout=True, sniff=False, sniffer_timeout=60):
+    """Асинхронный клиент Elasticsearch с настроенным пулом соединений.
+
+    ``maxsize`` — соединений на узел: срезы обучения и страницы мониторинга
+    идут параллельно и не должны ждать друг друга в пуле. Сжатие gzip
+    включается для запросов и ответов. Повторы делаются при таймауте и
+    ответах 429/502/503/504. Sniffing нужен только для кластера из
+    нескольких узлов: клиент сам находит остальные узлы.
+    """
+    sniff_options = {}
+    if sniff:
+        sniff_options = {
+            "sniff_on_start": True,
+            "sniff_on_connection_fail": True,
+            "sniffer_timeout": sniffer_timeout,
+        }
+    return AsyncElasticsearch(
+        [f"http://{host}:{port}"],
+        maxsize=maxsize,
+        http_compress=http_compress,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_on_timeout=retry_on_timeout,
+        retry_on_status=(429, 502, 503, 504),
+        serializer=make_serializer(),
+        **sniff_options
+    )
@@ -0,0 +1,123 @@
+import zlib
+
+import numpy as np
+
+from sql_lexer import tokenize
+
+FEATURE_NAMES = ("length", "select", "where", "join", "semicolon_comment", "union")
+# Увеличивается при любом изменении состава или смысла признаков:
+# сохранённые модели со старой версией не загружаются
+FEATURE_SCHEMA_VERSION = 1
+
+FEATURE_MODES = ("basic", "hashed")
+# Хеши лексем запоминаются, пока их не больше этого числа; потом память сбрасывается
+_TOKEN_HASH_CACHE_SIZE = 100000
+_token_hashes = {}
+_NGRAM_PRIME = np.uint64(1000003)
+_HASH_MASK = np.uint64(0xFFFFFFFF)
+
+
+def _token_row(tokens):
+    """Признаки одного разобранного запроса списком"""
+    keywords = tokens.keywords
+    return [
+        tokens.length,
+        keywords["select"],
+        keywords["where"],
+        keywords["join"],
+        tokens.semicolon_comments,
+        keywords["union"],
+    ]
+
+
+def features_from_tokens(token_batch):
+    """Матрица признаков (N, F) float32 по результатам tokenize"""
+    if not isinstance(token_batch, (list, tuple)):
+        token_batch = list(token_batch)
+    X = np.empty((len(token_batch), len(FEATURE_NAMES)), dtype=np.float32)
+    for i, tokens in enumerate(token_batch):
+        X[i] = _token_row(tokens)
+    return X
+
+
+def _token_hash(token):
+    value = _token_hashes.get(token)
+    if value is None:
+        if len(_token_hashes) >= _TOKEN_HASH_CACHE_SIZE:
+            _token_hashes.clear()
+        value = _token_hashes[token] = zlib.crc32(token.encode())
+    return value
+
+
+class FeatureSpace:
+    """Пространство признаков модели: базовые счётчики и, в режиме ``hashed``,
+    ещё ``width`` столбцов с числом хешированных n-грамм лексем (до ``ngram``
+    подряд). Хеш лексемы — crc32 её нормализованного текста, поэтому словарь
+    хранить не нужно, а одна и та же n-грамма всегда попадает в один столбец.
+
+    Параметры сохраняются в метаданных модели, поэтому загруженная модель
+    всегда получает признаки того вида, на котором обучалась.
+    """
+
+    def __init__(self, mode="basic", width=64, ngram=2):
+        if mode not in FEATURE_MODES:
+            raise ValueError(
+                f"неизвестный режим признаков {mode}, доступны: {', '.join(FEATURE_MODES)}"
+            )
+        self.mode = mode
+        self.width = width
+        self.ngram = ngram
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Пространство признаков сохранённой модели; у старых моделей — basic"""
+        return cls(
+            metadata.get("feature_mode", "basic"),
+            metadata.get("hash_width", 64),
+            metadata.get("hash_ngram", 2),
+        )
+
+    def metadata(self):
+        return {"feature_mode": self.mode, "hash_width": self.width, "hash_ngram": self.ngram}
+
+    @property
+    def names(self):
+        names = list(FEATURE_NAMES)
+        if self.mode == "hashed":
+            names += [f"ngram_{i}" for i in range(self.width)]
+        return names
+
+    def transform(self, token_batch):
+        """Матрица признаков (N, F) float32 по результатам tokenize"""
+        if not isinstance(token_batch, (list, tuple)):
+            token_batch = list(token_batch)
+        basic = features_from_tokens(token_batch)
+        if self.mode == "basic":
+            return basic
+
+        # Хеши лексем всей пачки подряд, rows — номер запроса каждой лексемы
+        lengths = [len(tokens.tokens) for tokens in token_batch]
+        hashes = np.fromiter(
+            (_token_hash(token) for tokens in token_batch for token in tokens.tokens),
+            dtype=np.uint64, count=sum(lengths)
+        )
+        rows = np.repeat(np.arange(len(token_batch), dtype=np.int64), lengths)
+
+        columns = [rows * self.width + (hashes % self.width).astype(np.int64)]
+        # Хеш n-граммы — хеш (n-1)-граммы, смешанный со следующей лексемой;
+        # n-граммы через границу запросов отбрасываются
+        level = hashes
+        for n in range(1, self.ngram):
+            level = ((level[:-1] * _NGRAM_PRIME) ^ hashes[n:]) & _HASH_MASK
+            same_row = rows[:-n] == rows[n:]
+            columns.append(
+                rows[:-n][same_row] * self.width + (level[same_row] % self.width).astype(np.int64)
+            )
+        counts = np.bincount(
+            np.concatenate(columns), minlength=len(token_batch) * self.width
+        ).reshape(len(token_batch), self.width)
+        return np.hstack([basic, counts.astype(np.float32)])
+
+    def transform_queries(self, queries):
+        """Признаки для пачки текстов запросов"""
+        return self.transform([tokenize(query or "") for query in queries])
@@ -0,0 +1,136 @@
+"""Компактная оценка обученного IsolationForest на NumPy.
+
+Деревья леса сводятся в плоские массивы узлов, и все деревья проходятся
+сразу для всех строк пачки: за один шаг каждая пара (строка, дерево)
+спускается на уровень ниже. Листья ссылаются сами на себя, поэтому
+достаточно max_depth одинаковых шагов без ветвлений. Одинаковые строки
+признаков в большой пачке проходят деревья один раз.
+
+Массивы хранятся в том же joblib-файле, что и раньше модель sklearn,
+и при загрузке с ``mmap_mode="r"`` отображаются в память.
+"""
+import numpy as np
+
+# Строк пачки за один проход: массив узлов (строки x деревья) остаётся в кэше
+CHUNK_ROWS = 512
+# С какого размера пачки искать одинаковые строки признаков
+DEDUP_MIN_ROWS = 64
+
+
+def _average_path_length(n_samples):
+    """Средняя длина пути неудачного поиска в BST из n элементов, как в sklearn"""
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    result = np.zeros_like(n_samples)
+    result[n_samples == 2] = 1.0
+    large = n_samples > 2
+    n = n_samples[large]
+    result[large] = 2.0 * (np.log(n - 1.0) + np.euler_gamma) - 2.0 * (n - 1.0) / n
+    return result
+
+
+class CompiledForest:
+    """Лес в виде массивов узлов с тем же decision_function, что у IsolationForest"""
+
+    def __init__(self, feature, threshold, children, leaf_depth, roots, max_depth,
+                 normalizer, offset, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        # Дети узла подряд: [левый, правый], переход — один gather по 2 * узел + направо
+        self.children = children
+        self.leaf_depth = leaf_depth
+        self.roots = roots
+        self.max_depth = max_depth
+        self.normalizer = normalizer
+        self.offset = offset
+        self.n_features = n_features
+
+    def score_samples(self, X):
+        """Оценки как у IsolationForest.score_samples: чем меньше, тем аномальнее"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"ожидается матрица с {self.n_features} признаками, получено {X.shape}")
+        inverse = None
+        if len(X) >= DEDUP_MIN_ROWS:
+            rows = X.view(np.dtype((np.void, X.itemsize * X.shape[1]))).ravel()
+            _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+            X = X[first]
+        depths = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), CHUNK_ROWS):
+            depths[start:start + CHUNK_ROWS] = self._depths(X[start:start + CHUNK_ROWS])
+        if inverse is not None:
+            depths = depths[inverse.ravel()]
+        if self.normalizer == 0:
+            # sklearn в этом случае считает 2 ** -1
+            return -0.5 * np.ones_like(depths)
+        return -(2.0 ** (-depths / self.normalizer))
+
+    def decision_function(self, X):
+        """Отрицательные значения — аномалии"""
+        return self.score_samples(X) - self.offset
+
+    def predict(self, X):
+        """1 — норма, -1 — аномалия"""
+        return np.where(self.decision_function(X) < 0, -1, 1)
+
+    def _depths(self, X):
+        # Индекс признака в плоском X строки: смещение строки плюс номер признака
+        flat = X.ravel()
+        row_offsets = (np.arange(len(X), dtype=np.int32) * self.n_features)[:, None]
+        node = np.repeat(self.roots[None, :], len(X), axis=0)
+        for _ in range(self.max_depth):
+            go_right = flat[row_offsets + self.feature[node]] > self.threshold[node]
+            node = self.children[2 * node + go_right]
+        return self.leaf_depth[node].sum(axis=1)
+
+
+def compile_forest(model):
+    """CompiledForest из обученного sklearn IsolationForest"""
+    n_features = model.n_features_in_
+    # Деревья, обученные на подмножестве признаков, ссылаются на его номера
+    subsample = getattr(model, "_max_features", n_features) != n_features
+
+    features, thresholds, children, leaf_depths, roots = [], [], [], [], []
+    max_depth = 0
+    offset = 0
+    for estimator, estimator_features in zip(model.estimators_, model.estimators_features_):
+        tree = estimator.tree_
+        count = tree.node_count
+        left = tree.children_left.astype(np.int32)
+        right = tree.children_right.astype(np.int32)
+        is_leaf = left == -1
+
+        # Узлы sklearn пронумерованы в прямом порядке обхода: родитель раньше детей
+        depth = np.zeros(count, dtype=np.float64)
+        for node in range(count):
+            if not is_leaf[node]:
+                depth[left[node]] = depth[right[node]] = depth[node] + 1
+
+        feature = tree.feature.astype(np.int32)
+        if subsample:
+            feature = np.asarray(estimator_features, dtype=np.int32)[np.maximum(feature, 0)]
+        nodes = np.arange(count, dtype=np.int32)
+        # Лист ссылается сам на себя и никогда не уходит влево
+        features.append(np.where(is_leaf, 0, feature))
+        thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+        children.append(np.stack([
+            np.where(is_leaf, nodes, left), np.where(is_leaf, nodes, right)
+        ], axis=1).ravel() + offset)
+        leaf_depths.append(np.where(
+            is_leaf, depth + _average_path_length(tree.n_node_samples), 0.0
+        ))
+        roots.append(offset)
+        max_depth = max(max_depth, tree.max_depth)
+        offset += count
+
+    max_samples = getattr(model, "max_samples_", None) or model._max_samples
+    return CompiledForest(
+        feature=np.concatenate(features).astype(np.int32),
+        threshold=np.concatenate(thresholds).astype(np.float64),
+        children=np.concatenate(children).astype(np.int32),
+        leaf_depth=np.concatenate(leaf_depths),
+        roots=np.asarray(roots, dtype=np.int32),
+        max_depth=max_depth,
+        normalizer=float(len(model.estimators_) * _average_path_length([max_samples])[0]),
+        offset=float(model.offset_),
+        n_features=n_features,
+    )
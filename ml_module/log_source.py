@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+import pandas as pd
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LOG_INDEX = "postgresql-logs-*"
+# Поля записи, которые нужны мониторингу и обучению; остальное из документа
+# filebeat (host, agent, ecs, log и т. д.) не передаётся и не разбирается
+LOG_FIELDS = ["@timestamp", "query", "user", "database"]
+# Из ответа поиска остаются только документы и ключи сортировки (и pit_id)
+MONITOR_FILTER_PATH = "hits.hits._source,hits.hits.sort"
+TRAINING_FILTER_PATH = "pit_id,hits.hits._source,hits.hits.sort"
+
+# Курсор идёт по времени индексации, которое ставит ingest pipeline модуля
+# postgresql filebeat: запись, проиндексированная с опозданием относительно
+# своего @timestamp, всё равно окажется после сохранённого курсора.
+# @timestamp и смещение строки в файле лога — уникальный порядок на docvalues
+# без fielddata по _id
+MONITOR_CURSOR_FIELD = "event.ingested"
+MONITOR_SORT = [
+    {MONITOR_CURSOR_FIELD: "asc"},
+    {"@timestamp": "asc"},
+    {"log.offset": {"order": "asc", "unmapped_type": "long"}},
+]
+
+
+class Checkpoint:
+    """Курсор источника логов, сохраняемый в файл между перезапусками"""
+
+    def __init__(self, path):
+        self.path = path
+        self.cursor = None
+
+    def load(self, default=None):
+        """Чтение курсора; без файла используется ``default``"""
+        try:
+            with open(self.path) as f:
+                self.cursor = json.load(f)["cursor"]
+            logger.info(f"Курсор восстановлен: {self.cursor}")
+        except FileNotFoundError:
+            self.cursor = default
+            logger.info(f"Курсор {self.path} не найден, начальная позиция: {default}")
+        return self.cursor
+
+    def save(self, cursor):
+        """Атомарная запись курсора через временный файл"""
+        self.cursor = cursor
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"cursor": cursor}, f)
+        os.replace(tmp_path, self.path)
+
+
+def start_cursor(cursor=None):
+    """Курсор для MONITOR_SORT: сохранённый или текущий момент.
+
+    Курсор прежнего формата ([@timestamp, log.offset]) переводится в новый:
+    время записи не больше времени её индексации, поэтому чтение продолжится
+    не позже старой позиции, а лишь повторит часть уже оценённых записей.
+    """
+    if cursor is None:
+        return [int(time.time() * 1000), 0, -1]
+    if len(cursor) != len(MONITOR_SORT):
+        logger.warning(f"Курсор {cursor} прежнего формата, чтение продолжится с {cursor[0]}")
+        return [cursor[0], 0, -1]
+    return cursor
+
+
+async def fetch_new_pages(es, search_after, page_size=5000, safety_lag=5):
+    """Страницы документов после ``search_after`` по возрастанию времени
+    индексации, пока не догоним конец индекса.
+
+    Документы, проиндексированные меньше ``safety_lag`` секунд назад, не
+    читаются: они могут быть ещё не видны поиску до refresh, а записи из
+    того же пакета filebeat — уже видны. Курсор сохраняет вызывающий код.
+    """
+    while True:
+        body = {
+            "size": page_size,
+            "_source": LOG_FIELDS,
+            "track_total_hits": False,
+            "sort": MONITOR_SORT,
+            "search_after": search_after,
+            "query": {"range": {MONITOR_CURSOR_FIELD: {"lte": f"now-{safety_lag}s"}}},
+        }
+        started = time.perf_counter()
+        res = await es.search(index=LOG_INDEX, body=body, filter_path=MONITOR_FILTER_PATH)
+        STAGE_SECONDS.labels("fetch").observe(time.perf_counter() - started)
+        # Без совпадений filter_path убирает и сам ключ hits
+        hits = res.get("hits", {}).get("hits", [])
+        if not hits:
+            return
+
+        yield hits
+        search_after = hits[-1]["sort"]
+
+        if len(hits) < page_size:
+            return
+
+
+class EsLogSource:
+    """Непрерывный поток страниц логов из Elasticsearch.
+
+    Позиция чтения в памяти опережает сохранённый курсор на число страниц,
+    которые ещё обрабатываются; на диск курсор попадает через commit.
+    """
+
+    def __init__(self, es, checkpoint, page_size=5000, safety_lag=5, poll_interval=1.0):
+        self.es = es
+        self.checkpoint = checkpoint
+        self.page_size = page_size
+        self.safety_lag = safety_lag
+        self.poll_interval = poll_interval
+        self.position = None
+
+    async def pages(self):
+        """Страницы (записи, курсор); догнав конец индекса, ждёт новых данных"""
+        if self.position is None:
+            # Без сохранённого курсора чтение начинается с текущего момента
+            cursor = self.checkpoint.cursor or self.checkpoint.load(default=start_cursor())
+            self.position = start_cursor(cursor)
+        while True:
+            async for hits in fetch_new_pages(
+                self.es, self.position, self.page_size, self.safety_lag
+            ):
+                self.position = hits[-1]["sort"]
+                yield [hit["_source"] for hit in hits], self.position
+            await asyncio.sleep(self.poll_interval)
+
+    def commit(self, cursor):
+        """Сохранение курсора полностью обработанных страниц"""
+        self.checkpoint.save(cursor)
+
+
+class Reservoir:
+    """Равномерная выборка фиксированного размера из потока (алгоритм R)"""
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.seen = 0
+        self.items = []
+        self._random = random.Random(seed)
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        index = self._random.randrange(self.seen)
+        if index < self.size:
+            self.items[index] = item
+
+
+async def _read_slice(es, pit_id, query, slice_id, slices, page_size, keep_alive, reservoir):
+    """Чтение одного среза PIT постранично через search_after в общую выборку"""
+    search_after = None
+    while True:
+        body = {
+            "size": page_size,
+            "_source": LOG_FIELDS,
+            "track_total_hits": False,
+            "query": query,
+            "pit": {"id": pit_id, "keep_alive": keep_alive},
+            "sort": [{"_shard_doc": "asc"}],
+        }
+        if slices > 1:
+            body["slice"] = {"id": slice_id, "max": slices}
+        if search_after is not None:
+            body["search_after"] = search_after
+
+        res = await es.search(body=body, filter_path=TRAINING_FILTER_PATH)
+        hits = res.get("hits", {}).get("hits", [])
+        pit_id = res.get("pit_id", pit_id)
+        for hit in hits:
+            source = hit["_source"]
+            reservoir.add((
+                source.get("@timestamp"), source.get("query", ""),
+                source.get("user", ""), source.get("database", "")
+            ))
+        if len(hits) < page_size:
+            return
+        search_after = hits[-1]["sort"]
+
+
+async def load_training_data(es, since=None, sample_size=200000, slices=4,
+                             page_size=10000, keep_alive="2m"):
+    """Исторические запросы для обучения: PIT и параллельные срезы search_after.
+
+    ``since`` ограничивает окно снизу (значение для range по @timestamp,
+    например ``now-7d``). Из окна берётся равномерная выборка не больше
+    ``sample_size`` записей, так что память не зависит от объёма логов.
+    Возвращает DataFrame с колонками timestamp, query, user, database и
+    число просмотренных документов.
+    """
+    query = {"match_all": {}}
+    if since is not None:
+        query = {"range": {"@timestamp": {"gte": since}}}
+
+    # Срезы выполняются в одном цикле событий, выборка общая без блокировок
+    reservoir = Reservoir(sample_size)
+    pit = await es.open_point_in_time(index=LOG_INDEX, keep_alive=keep_alive)
+    try:
+        await asyncio.gather(*(
+            _read_slice(es, pit["id"], query, slice_id, slices, page_size, keep_alive, reservoir)
+            for slice_id in range(slices)
+        ))
+    finally:
+        await es.close_point_in_time(body={"id": pit["id"]})
+
+    df = pd.DataFrame(reservoir.items, columns=["timestamp", "query", "user", "database"])
+    return df, reservoir.seen
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# log_line_prefix='%m [%p] %q%u@%d ': у фоновых процессов части user@db нет
+_LINE_RE = re.compile(
+    r'(?P<timestamp>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?(?: [A-Za-z+\-\d]+)?) '
+    r'\[(?P<pid>\d+)\] '
+    r'(?:(?P<user>[^@\s]*)@(?P<database>\S*) )?'
+    r'(?P<level>[A-Z]+\d?):  (?P<message>.*)',
+    re.S
+)
+# Текст запроса из сообщения; parse/bind дублируют execute и пропускаются
+_STATEMENT_RE = re.compile(
+    r'(?:duration: [\d.]+ ms\s+)?(?:statement|execute [^:]*): (?P<query>.*)',
+    re.S
+)
+
+
+def _iso_timestamp(timestamp):
+    """2024-05-01 12:00:00.123 UTC -> 2024-05-01T12:00:00.123Z"""
+    if timestamp.endswith(" UTC"):
+        return timestamp[:-4].replace(" ", "T", 1) + "Z"
+    return timestamp.replace(" ", "T", 1)
+
+
+def parse_entry(lines):
+    """Запись лога из строк одного сообщения или None, если это не запрос.
+
+    Поля совпадают с документом filebeat, который читает мониторинг:
+    ``@timestamp``, ``query``, ``user``, ``database``.
+    """
+    match = _LINE_RE.match("\n".join(lines))
+    if match is None:
+        return None
+    statement = _STATEMENT_RE.match(match.group("message"))
+    if statement is None:
+        return None
+    return {
+        "@timestamp": _iso_timestamp(match.group("timestamp")),
+        "query": statement.group("query"),
+        "user": match.group("user") or "",
+        "database": match.group("database") or "",
+    }
+
+
+def iter_entries(lines):
+    """Группировка строк лога в сообщения: продолжения начинаются с табуляции"""
+    entry = []
+    for line in lines:
+        if entry and not line.startswith("\t"):
+            yield entry
+            entry = []
+        entry.append(line[1:] if entry else line)
+    if entry:
+        yield entry
+
+
+class LogTailer:
+    """Источник записей прямо из postgresql.log, минуя filebeat и Elasticsearch.
+
+    Файл читается по мере дописывания; замена файла (другой inode) и
+    усечение обнаруживаются при простое, после чего чтение идёт с начала
+    нового файла. Курсор — [inode, смещение начала необработанного сообщения].
+    """
+
+    def __init__(self, path, checkpoint, from_start=False, poll_interval=0.2,
+                 chunk_size=1 << 20):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+
+    async def pages(self):
+        """Страницы (записи, курсор) по мере появления строк в файле"""
+        cursor = self.checkpoint.cursor or self.checkpoint.load()
+        while True:
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            with f:
+                stat = os.fstat(f.fileno())
+                if cursor is None and not self.from_start:
+                    offset = stat.st_size
+                elif cursor is not None and cursor[0] == stat.st_ino and cursor[1] <= stat.st_size:
+                    offset = cursor[1]
+                else:
+                    offset = 0
+                logger.info(f"Чтение {self.path} с позиции {offset}")
+                f.seek(offset)
+                async for records, cursor in self._follow(f, stat.st_ino, offset):
+                    yield records, cursor
+            # Новый файл после ротации читается с начала
+            cursor = [None, 0]
+
+    def commit(self, cursor):
+        """Сохранение позиции полностью обработанных сообщений"""
+        self.checkpoint.save(cursor)
+
+    async def _follow(self, f, inode, offset):
+        buffer = b""
+        pending = []            # строки последнего, возможно незавершённого сообщения
+        pending_start = offset  # смещение начала этого сообщения
+        position = offset       # смещение после последней полной строки
+        draining = False
+        while True:
+            data = f.read(self.chunk_size)
+            if data:
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                records = []
+                for line in lines:
+                    text = line.decode("utf-8", "replace")
+                    if pending and not text.startswith("\t"):
+                        self._append(records, pending)
+                        pending = []
+                        pending_start = position
+                    pending.append(text)
+                    position += len(line) + 1
+                if records:
+                    yield records, [inode, pending_start]
+                continue
+
+            # Новых данных нет: последнее сообщение PostgreSQL уже дописал целиком
+            if pending:
+                records = []
+                self._append(records, pending)
+                pending = []
+                pending_start = position
+                if records:
+                    yield records, [inode, position]
+            if draining:
+                return
+            if self._replaced(inode, position):
+                # Дочитываем то, что успели записать в старый файл до ротации
+                draining = True
+                continue
+            await asyncio.sleep(self.poll_interval)
+
+    @staticmethod
+    def _append(records, lines):
+        for entry in iter_entries(lines):
+            record = parse_entry(entry)
+            if record is not None:
+                records.append(record)
+
+    def _replaced(self, inode, position):
+        """Файл заменён при ротации или усечён"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != inode or stat.st_size < position
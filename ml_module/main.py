@@ -1,17 +1,28 @@
-from elasticsearch import AsyncElasticsearch
 from aiogram import Bot
-import pandas as pd
-from sklearn.ensemble import IsolationForest
-import numpy as np
-import re
 import asyncio
 from dotenv import load_dotenv
 import os
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 import pytz
 
+from aggregates import AnomalyStats
+from alerts import AlertDeduplicator, AlertQueue
+from detector import Detector, ProcessPoolScorer, fit_models
+from es_client import make_es_client
+from features import FeatureSpace
+from log_source import Checkpoint, EsLogSource, load_training_data
+from log_tail import LogTailer
+from metrics import REGISTRY, Counter, Gauge, start_metrics_server
+from model_store import load_model, prune_partitions, save_model, save_partitions
+from pipeline import Pipeline
+from query_cache import VerdictCache
+from status import RateMeter, StatusServer
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -20,97 +31,236 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 ELASTICSEARCH_HOST = os.getenv('ELASTICSEARCH_HOST', 'elasticsearch')
+ELASTICSEARCH_PORT = int(os.getenv('ELASTICSEARCH_PORT', '9200'))
+ES_MAXSIZE = int(os.getenv('ES_MAXSIZE', '25'))
+ES_HTTP_COMPRESS = os.getenv('ES_HTTP_COMPRESS', 'true').lower() == 'true'
+ES_TIMEOUT = float(os.getenv('ES_TIMEOUT', '30'))
+ES_MAX_RETRIES = int(os.getenv('ES_MAX_RETRIES', '3'))
+ES_RETRY_ON_TIMEOUT = os.getenv('ES_RETRY_ON_TIMEOUT', 'true').lower() == 'true'
+ES_SNIFF = os.getenv('ES_SNIFF', 'false').lower() == 'true'
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
+VERDICT_CACHE_SIZE = int(os.getenv('VERDICT_CACHE_SIZE', '10000'))
+VERDICT_CACHE_TTL = int(os.getenv('VERDICT_CACHE_TTL', '3600'))
+CHECKPOINT_PATH = os.getenv('CHECKPOINT_PATH', '/var/lib/ml_monitor/cursor.json')
+MONITOR_PAGE_SIZE = int(os.getenv('MONITOR_PAGE_SIZE', '5000'))
+MONITOR_SAFETY_LAG = int(os.getenv('MONITOR_SAFETY_LAG', '5'))
+MONITOR_POLL_INTERVAL = float(os.getenv('MONITOR_POLL_INTERVAL', '1'))
+SCORING_WORKERS = int(os.getenv('SCORING_WORKERS', '1'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '8'))
+SCORING_BACKEND = os.getenv('SCORING_BACKEND', 'inline')
+INPUT_MODE = os.getenv('INPUT_MODE', 'elasticsearch')
+POSTGRES_LOG_PATH = os.getenv('POSTGRES_LOG_PATH', '/var/log/postgresql/postgresql.log')
+TAIL_CHECKPOINT_PATH = os.getenv('TAIL_CHECKPOINT_PATH', '/var/lib/ml_monitor/tail_cursor.json')
+SCORING_PROCESSES = int(os.getenv('SCORING_PROCESSES', str(os.cpu_count() or 1)))
+TRAIN_WINDOW_DAYS = int(os.getenv('TRAIN_WINDOW_DAYS', '7'))
+TRAIN_SLICES = int(os.getenv('TRAIN_SLICES', '4'))
+TRAIN_SAMPLE_SIZE = int(os.getenv('TRAIN_SAMPLE_SIZE', '200000'))
+RETRAIN_INTERVAL_HOURS = float(os.getenv('RETRAIN_INTERVAL_HOURS', '24'))
+PARTITION_MIN_SAMPLES = int(os.getenv('PARTITION_MIN_SAMPLES', '1000'))
+PARTITION_CACHE_SIZE = int(os.getenv('PARTITION_CACHE_SIZE', '32'))
+MODEL_PATH = os.getenv('MODEL_PATH', '/var/lib/ml_monitor/model.joblib')
+MODEL_MAX_AGE_HOURS = float(os.getenv('MODEL_MAX_AGE_HOURS', '24'))
+MODEL_EVALUATOR = os.getenv('MODEL_EVALUATOR', 'compiled')
+FEATURE_MODE = os.getenv('FEATURE_MODE', 'basic')
+FEATURE_HASH_WIDTH = int(os.getenv('FEATURE_HASH_WIDTH', '64'))
+FEATURE_HASH_NGRAM = int(os.getenv('FEATURE_HASH_NGRAM', '2'))
+ALERT_QUEUE_SIZE = int(os.getenv('ALERT_QUEUE_SIZE', '10000'))
+ALERT_RATE_PER_MINUTE = int(os.getenv('ALERT_RATE_PER_MINUTE', '20'))
+ALERT_SUPPRESS_SECONDS = int(os.getenv('ALERT_SUPPRESS_SECONDS', '300'))
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+STATUS_SOCKET = os.getenv('STATUS_SOCKET', '/tmp/ml_monitor.sock')
+STATUS_ERROR_WINDOW = int(os.getenv('STATUS_ERROR_WINDOW', '900'))
+RECENT_ANOMALIES = int(os.getenv('RECENT_ANOMALIES', '20'))
 
 if not all([TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID]):
     logger.critical("Не заданы TELEGRAM_BOT_TOKEN или TELEGRAM_CHAT_ID в .env")
     exit(1)
 
-# Инициализация ML-модели
-model = IsolationForest(
-    n_estimators=100,
-    contamination=0.01,
-    random_state=42
-)
-
 # Асинхронный клиент Elasticsearch
-es = AsyncElasticsearch([f'http://{ELASTICSEARCH_HOST}:9200'])
+es = make_es_client(
+    ELASTICSEARCH_HOST, ELASTICSEARCH_PORT,
+    maxsize=ES_MAXSIZE,
+    http_compress=ES_HTTP_COMPRESS,
+    timeout=ES_TIMEOUT,
+    max_retries=ES_MAX_RETRIES,
+    retry_on_timeout=ES_RETRY_ON_TIMEOUT,
+    sniff=ES_SNIFF
+)
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Оповещения об аномалиях уходят через очередь, не задерживая проверку
+alert_queue = AlertQueue(
+    bot, TELEGRAM_CHAT_ID, maxsize=ALERT_QUEUE_SIZE, rate_per_minute=ALERT_RATE_PER_MINUTE,
+    error_window=STATUS_ERROR_WINDOW
+)
+# Повторы одного запроса от одного пользователя не рассылаются заново
+deduplicator = AlertDeduplicator(window=ALERT_SUPPRESS_SECONDS)
 
-DANGEROUS_PATTERNS = [
-    r'drop\s+database',
-    r'truncate\s+table',
-    r'delete\s+from\s+\w+\s*(?!where)',
-    r'alter\s+table\s+\w+\s+drop',
-    r';\s*--',
-    r'1\s*=\s*1',
-    r'union\s+select',
-    r'insert\s+into\s+\w+\s+values',
-    r'update\s+\w+\s+set\s+\w+\s*=\s*\w+\s*(?!where)'
-]
-
-
-def extract_features(query):
-    """Синхронная обработка запроса"""
-    return np.array([
-        len(query),
-        len(re.findall(r'\bSELECT\b', query, re.IGNORECASE)),
-        len(re.findall(r'\bWHERE\b', query, re.IGNORECASE)),
-        len(re.findall(r'\bJOIN\b', query, re.IGNORECASE)),
-        len(re.findall(r';--', query)),
-        len(re.findall(r'\bUNION\b', query, re.IGNORECASE))
-    ]).reshape(1, -1)
-
-
-def check_dangerous_queries(query):
-    """Синхронная проверка запроса"""
-    query_lower = query.lower()
-    for pattern in DANGEROUS_PATTERNS:
-        if re.search(pattern, query_lower):
-            return True, pattern
-
-    features = extract_features(query)
-    prediction = model.predict(features)
-    if prediction[0] == -1:
-        return True, "ML-аномалия"
-
-    return False, None
+# Детектор с кэшем вердиктов по отпечатку запроса; модель появится после обучения
+detector = Detector(
+    VerdictCache(maxsize=VERDICT_CACHE_SIZE, ttl=VERDICT_CACHE_TTL),
+    partition_cache_size=PARTITION_CACHE_SIZE
+)
+# Пространство признаков для новых моделей; загруженная модель несёт своё в метаданных
+feature_space = FeatureSpace(FEATURE_MODE, FEATURE_HASH_WIDTH, FEATURE_HASH_NGRAM)
+# Скользящие счётчики аномалий для /top, /stats и /recent
+anomaly_stats = AnomalyStats(recent_size=RECENT_ANOMALIES)
+started_at = time.time()
+# Ошибки вне конвейера; ошибки чтения и оценки считает сам Pipeline
+errors = {"training": 0}
+training_errors = RateMeter(STATUS_ERROR_WINDOW)
+# Фоновые задачи: цикл событий держит на них только слабые ссылки
+background_tasks = set()
+
+# Счётчики, которые и так ведут очередь оповещений и кэш, читаются при запросе /metrics
+REGISTRY.register(Counter(
+    "sqlmon_alerts_sent_total", "Отправлено сообщений в Telegram",
+    fn=lambda: alert_queue.sent
+))
+REGISTRY.register(Counter(
+    "sqlmon_alerts_dropped_total", "Потеряно оповещений: переполнение очереди или ошибки отправки",
+    fn=lambda: alert_queue.dropped
+))
+REGISTRY.register(Counter(
+    "sqlmon_alerts_suppressed_total", "Подавлено повторов оповещений",
+    fn=lambda: deduplicator.suppressed
+))
+REGISTRY.register(Gauge(
+    "sqlmon_alert_queue_size", "Оповещений в очереди на отправку",
+    fn=alert_queue.qsize
+))
+REGISTRY.register(Counter(
+    "sqlmon_verdict_cache_hits_total", "Попадания в кэш вердиктов",
+    fn=lambda: detector.cache.hits
+))
+REGISTRY.register(Counter(
+    "sqlmon_verdict_cache_misses_total", "Промахи кэша вердиктов",
+    fn=lambda: detector.cache.misses
+))
+REGISTRY.register(Gauge(
+    "sqlmon_verdict_cache_size", "Записей в кэше вердиктов",
+    fn=lambda: len(detector.cache)
+))
 
 
 async def send_alert(message):
-    """Отправка уведомления"""
+    """Немедленная отправка уведомления (для ошибок, минуя очередь)"""
     try:
         await bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения: {e}")
 
 
+async def report_pipeline_error(stage, message):
+    """Ошибка конвейера в общую очередь оповещений: пока стадия повторяет
+    попытки, в чат уходит одно сообщение за окно подавления, а не каждая ошибка"""
+    alert_msg = deduplicator.admit(("error", stage), message)
+    if alert_msg:
+        alert_queue.put(alert_msg)
+
+
 async def train_model():
-    """Обучение модели"""
+    """Обучение модели на скользящем окне логов"""
     try:
-        query = {"query": {"match_all": {}}, "size": 1000}
-        res = await es.search(index="postgresql-logs-*", body=query)
-
-        df = pd.DataFrame([
-            {
-                "timestamp": hit["_source"]["@timestamp"],
-                "query": hit["_source"].get("query", ""),
-                "user": hit["_source"].get("user", "")
-            }
-            for hit in res["hits"]["hits"]
-        ])
+        df, seen = await load_training_data(
+            es,
+            since=f"now-{TRAIN_WINDOW_DAYS}d",
+            sample_size=TRAIN_SAMPLE_SIZE,
+            slices=TRAIN_SLICES
+        )
 
         if not df.empty:
-            X = np.array([extract_features(q) for q in df["query"]])
-            model.fit(X)
-            logger.info(f"Модель обучена на {len(df)} записях")
+            # Обучение и запись на диск не блокируют мониторинг. Построение
+            # признаков и деревьев идёт в отдельном процессе, чтобы не
+            # конкурировать за GIL с оценкой; процесс создаётся на каждое
+            # обучение, и его аварийное завершение не ломает следующие
+            loop = asyncio.get_running_loop()
+            training_executor = ProcessPoolExecutor(max_workers=1)
+            try:
+                model, partition_models = await loop.run_in_executor(
+                    training_executor, fit_models,
+                    df["query"].tolist(),
+                    list(zip(df["user"], df["database"])),
+                    PARTITION_MIN_SAMPLES,
+                    MODEL_EVALUATOR == 'compiled',
+                    feature_space
+                )
+            finally:
+                training_executor.shutdown(wait=False)
+            version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+            # Модели разделов пишутся в каталог версии до замены основного файла
+            partitions_root = f"{MODEL_PATH}.partitions"
+            partitions_dir = os.path.join(partitions_root, version)
+            partitions = await loop.run_in_executor(
+                None, save_partitions, partitions_dir, partition_models
+            )
+            metadata = {
+                "version": version,
+                "trained_at": time.time(),
+                "window_days": TRAIN_WINDOW_DAYS,
+                "window_start": df["timestamp"].min(),
+                "window_end": df["timestamp"].max(),
+                "samples": len(df),
+                "evaluator": MODEL_EVALUATOR,
+                "seen": seen,
+                "partitions_dir": partitions_dir,
+                "partitions": partitions,
+                **feature_space.metadata(),
+            }
+            await loop.run_in_executor(None, save_model, MODEL_PATH, model, metadata)
+            previous_version = detector.model_info.get("version")
+            detector.set_model(model, metadata)
+            # Предыдущую версию ещё могут читать процессы пула оценки
+            prune_partitions(partitions_root, {version, previous_version})
+            logger.info(
+                f"Модель {metadata['version']} обучена на {len(df)} записях "
+                f"из {seen} за {TRAIN_WINDOW_DAYS} дн., моделей разделов: {len(partitions)}"
+            )
 
     except Exception as e:
+        errors["training"] += 1
+        training_errors.add()
         logger.error(f"Ошибка обучения модели: {e}")
         await send_alert(f"Ошибка обучения модели: {e}")
 
 
+def status_snapshot(pipeline):
+    """Сводка для /status бота: только счётчики в памяти, без запросов к Elasticsearch.
+
+    Отставание считается на момент запроса: от @timestamp последней записи,
+    а если его не разобрать — от времени её обработки.
+    """
+    now = time.time()
+    lag = pipeline.ingest_lag()
+    if lag is None and pipeline.last_processed_at is not None:
+        lag = now - pipeline.last_processed_at
+    recent_errors = {stage: meter.count(now) for stage, meter in pipeline.recent_errors.items()}
+    return {
+        "pid": os.getpid(),
+        "uptime": now - started_at,
+        "input_mode": INPUT_MODE,
+        "last_timestamp": pipeline.last_timestamp,
+        "last_processed_at": pipeline.last_processed_at,
+        "ingest_lag": lag,
+        "processed": pipeline.processed,
+        "anomalies": pipeline.anomalies,
+        "throughput": pipeline.throughput.rate(),
+        "pipeline_backlog": pipeline.backlog(),
+        "alert_queue": alert_queue.qsize(),
+        "model_version": detector.model_info.get("version"),
+        "model_trained_at": detector.model_info.get("trained_at"),
+        "partitions": len(detector.partitions),
+        "errors": dict(pipeline.errors, alerts_dropped=alert_queue.dropped, **errors),
+        "recent_errors": dict(
+            recent_errors,
+            alerts_dropped=alert_queue.recent_drops.count(now),
+            training=training_errors.count(now)
+        ),
+        "error_window": STATUS_ERROR_WINDOW,
+    }
+
+
 async def check_connections():
     """Проверка подключений"""
     try:
@@ -127,57 +277,74 @@ async def check_connections():
         exit(1)
 
 
-async def monitor_logs():
-    """Основная задача мониторинга"""
-    try:
-        if not await check_connections():
-            return
-
-        last_checked_time = None
-        query = {"query": {"range": {"@timestamp": {"gt": last_checked_time}}}}
-        res = await es.search(index="postgresql-logs-*", body=query)
-
-        if res['hits']['hits']:
-            last_checked_time = res['hits']['hits'][-1]['_source']['@timestamp']
-
-            for hit in res['hits']['hits']:
-                source = hit['_source']
-                query_text = source.get('query', '')
-
-                is_dangerous, reason = check_dangerous_queries(query_text)
-                if is_dangerous:
-                    alert_msg = (
-                        f"Обнаружена аномалия!\n"
-                        f"Время: {source['@timestamp']}\n"
-                        f"Пользователь: {source.get('user', 'N/A')}\n"
-                        f"Запрос: {query_text[:300]}...\n"
-                        f"Причина: {reason}"
-                    )
-                    await send_alert(alert_msg)
-
-    except Exception as e:
-        error_msg = f"Ошибка мониторинга: {str(e)}"
-        logger.error(error_msg)
-        await send_alert(error_msg)
-
-
 async def main():
     """Основная функция инициализации"""
     await check_connections()
-    await train_model()
-
-    # Настройка планировщика
+    alert_queue.start()
+    await start_metrics_server(port=METRICS_PORT)
+
+    # Тёплый старт: сохранённая модель доступна сразу, переобучение идёт в фоне
+    loaded = load_model(MODEL_PATH)
+    if loaded is not None:
+        model, metadata = loaded
+        detector.set_model(model, metadata)
+        logger.info(f"Загружена модель {metadata['version']} ({metadata['samples']} записей)")
+    if (loaded is None
+            or time.time() - loaded[1]["trained_at"] > MODEL_MAX_AGE_HOURS * 3600
+            or FeatureSpace.from_metadata(loaded[1]).metadata() != feature_space.metadata()):
+        training = asyncio.create_task(train_model())
+        background_tasks.add(training)
+        training.add_done_callback(background_tasks.discard)
+
+    # Периодическое переобучение; новая модель подменяется без остановки оценки
     scheduler = AsyncIOScheduler(timezone=pytz.timezone("Europe/Moscow"))
     scheduler.add_job(
-        monitor_logs,
-        IntervalTrigger(seconds=30),
+        train_model,
+        IntervalTrigger(hours=RETRAIN_INTERVAL_HOURS),
         max_instances=1
     )
     scheduler.start()
 
-    # Бесконечный цикл
-    while True:
-        await asyncio.sleep(1)
+    # Непрерывный конвейер вместо опроса по расписанию; позиция чтения
+    # сохраняется между перезапусками
+    if INPUT_MODE == 'file':
+        source = LogTailer(POSTGRES_LOG_PATH, Checkpoint(TAIL_CHECKPOINT_PATH))
+        logger.info(f"Чтение логов напрямую из {POSTGRES_LOG_PATH}")
+    else:
+        source = EsLogSource(
+            es, Checkpoint(CHECKPOINT_PATH),
+            page_size=MONITOR_PAGE_SIZE,
+            safety_lag=MONITOR_SAFETY_LAG,
+            poll_interval=MONITOR_POLL_INTERVAL
+        )
+    score = detector.score_async
+    scoring_workers = SCORING_WORKERS
+    if SCORING_BACKEND == 'process':
+        # Оценщиков не меньше, чем процессов, иначе часть ядер простаивает
+        score = ProcessPoolScorer(detector, SCORING_PROCESSES).score
+        scoring_workers = max(SCORING_WORKERS, SCORING_PROCESSES)
+        logger.info(f"Оценка в пуле из {SCORING_PROCESSES} процессов")
+
+    pipeline = Pipeline(
+        source, score, deduplicator, alert_queue,
+        scoring_workers=scoring_workers,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        on_error=report_pipeline_error,
+        stats=anomaly_stats,
+        error_window=STATUS_ERROR_WINDOW
+    )
+    REGISTRY.register(Gauge(
+        "sqlmon_ingest_lag_seconds", "Отставание от @timestamp последней обработанной записи",
+        fn=pipeline.ingest_lag
+    ))
+    status_server = StatusServer(STATUS_SOCKET, {
+        "status": lambda args: status_snapshot(pipeline),
+        "top": lambda args: anomaly_stats.top(*args[:1]),
+        "stats": lambda args: anomaly_stats.user_stats(args[0] if args else ""),
+        "recent": lambda args: anomaly_stats.recent(),
+    })
+    await status_server.start()
+    await pipeline.run()
 
 
 if __name__ == "__main__":
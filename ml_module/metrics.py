@@ -0,0 +1,216 @@
+"""Метрики в текстовом формате Prometheus и HTTP-эндпоинт /metrics.
+
+Эндпоинт обслуживается тем же циклом событий, что и конвейер.
+"""
+import asyncio
+import logging
+import math
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._children = {}
+
+    def labels(self, *values, **kwargs):
+        """Дочерняя метрика с конкретными значениями меток"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if self.fn is not None:
+            lines.append(f"{self.name} {_format_value(self.fn())}")
+        elif not self.labelnames:
+            lines += self._render_child(self.labels(), ())
+        else:
+            for values, child in sorted(self._children.items()):
+                lines += self._render_child(child, values)
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Монотонный счётчик; ``fn`` — значение, которое считается где-то ещё"""
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, child, values):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class Gauge(Counter):
+    """Текущее значение; ``fn`` может вернуть None, пока значения нет"""
+    type = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Histogram(_Metric):
+    """Гистограмма длительностей с кумулятивными корзинами"""
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, child, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик для одного эндпоинта"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Все метрики в текстовом формате экспозиции Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+QUERIES = REGISTRY.register(Counter(
+    "sqlmon_queries_total", "Обработано запросов из логов"
+))
+ANOMALIES = REGISTRY.register(Counter(
+    "sqlmon_anomalies_total", "Обнаружено аномалий по причинам", ["reason"]
+))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "sqlmon_stage_seconds",
+    "Длительность стадий обработки пачки: fetch, rules, features, model, score, alert_send",
+    ["stage"]
+))
+
+
+def observe_stages(timings):
+    """Перенос длительностей стадий пачки в гистограмму"""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def parse_timestamp(timestamp):
+    """Время записи из ISO-строки (``2024-05-01T12:00:00.123Z``) в секундах
+    эпохи; None, если время не разобрать"""
+    try:
+        record_time = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if record_time.tzinfo is None:
+        return None
+    return record_time.timestamp()
+
+
+async def _handle(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", REGISTRY.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Ошибка обработки запроса метрик: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host="0.0.0.0", port=9108):
+    """Запуск HTTP-сервера метрик в текущем цикле событий"""
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
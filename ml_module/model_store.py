@@ -0,0 +1,77 @@
+import logging
+import os
+import shutil
+
+import joblib
+
+from features import FEATURE_SCHEMA_VERSION, FeatureSpace
+
+logger = logging.getLogger(__name__)
+
+
+def save_model(path, model, metadata):
+    """Атомарное сохранение модели с метаданными через временный файл"""
+    metadata = dict(
+        metadata,
+        schema_version=FEATURE_SCHEMA_VERSION,
+        feature_names=FeatureSpace.from_metadata(metadata).names,
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    joblib.dump({"model": model, "metadata": metadata}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_model(path):
+    """Загрузка сохранённой модели: (модель, метаданные) или None.
+
+    Массивы отображаются в память (mmap), поэтому старт не зависит от
+    размера модели. Модель с другой версией признаков отбрасывается.
+    """
+    try:
+        saved = joblib.load(path, mmap_mode="r")
+    except FileNotFoundError:
+        logger.info(f"Сохранённая модель не найдена: {path}")
+        return None
+    except Exception as e:
+        logger.error(f"Не удалось загрузить модель {path}: {e}")
+        return None
+
+    metadata = saved["metadata"]
+    if metadata.get("schema_version") != FEATURE_SCHEMA_VERSION:
+        logger.warning(
+            f"Версия признаков модели {metadata.get('schema_version')} "
+            f"не совпадает с текущей {FEATURE_SCHEMA_VERSION}, модель не используется"
+        )
+        return None
+    return saved["model"], metadata
+
+
+def save_partitions(directory, models):
+    """Запись моделей разделов в каталог версии.
+
+    Возвращает индекс: имя файла -> [пользователь, база].
+    """
+    os.makedirs(directory, exist_ok=True)
+    index = {}
+    for i, (key, model) in enumerate(models.items()):
+        name = f"{i}.joblib"
+        joblib.dump(model, os.path.join(directory, name))
+        index[name] = list(key)
+    return index
+
+
+def load_partition(path):
+    """Загрузка модели раздела с отображением массивов в память"""
+    return joblib.load(path, mmap_mode="r")
+
+
+def prune_partitions(root, keep):
+    """Удаление каталогов версий моделей разделов, кроме перечисленных в keep"""
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name not in keep:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
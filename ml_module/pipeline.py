@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from alerts import format_alert
+from metrics import ANOMALIES, QUERIES, STAGE_SECONDS, parse_timestamp
+from status import RateMeter
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """Непрерывная обработка логов: чтение -> оценка -> оповещения.
+
+    Стадии связаны ограниченными очередями, поэтому медленная оценка или
+    отправка приостанавливает чтение, а не копит страницы в памяти. Курсор
+    источника фиксируется только после обработки страницы и строго по
+    порядку страниц, даже если оценщики завершают их вразнобой.
+    """
+
+    def __init__(self, source, score, deduplicator, alert_queue, scoring_workers=1,
+                 queue_size=8, flush_interval=1.0, retry_delay=5.0, on_error=None,
+                 stats=None, error_window=900):
+        self.source = source
+        self.score = score
+        self.deduplicator = deduplicator
+        self.alert_queue = alert_queue
+        self.scoring_workers = scoring_workers
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.on_error = on_error
+        self.stats = stats
+        self.error_window = error_window
+        self.processed = 0
+        self.anomalies = 0
+        # Состояние для /status: ошибки по стадиям (всего и за последние
+        # error_window секунд), последняя запись, скорость
+        self.errors = Counter()
+        self.recent_errors = {}
+        self.last_timestamp = None
+        self.last_processed_at = None
+        self.last_record_at = None
+        self.throughput = RateMeter()
+        self._queues = ()
+
+    async def run(self):
+        """Запуск стадий; завершается, когда источник исчерпан"""
+        pages = asyncio.Queue(maxsize=self.queue_size)
+        results = asyncio.Queue(maxsize=self.queue_size)
+        self._queues = (pages, results)
+        tasks = [asyncio.create_task(self._fetch(pages))]
+        tasks += [
+            asyncio.create_task(self._score(pages, results))
+            for _ in range(self.scoring_workers)
+        ]
+        tasks.append(asyncio.create_task(self._alert(results)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def backlog(self):
+        """Страниц в очередях между стадиями"""
+        return sum(queue.qsize() for queue in self._queues)
+
+    def ingest_lag(self):
+        """Отставание от @timestamp последней обработанной записи на текущий
+        момент: без новых записей оно растёт; None, пока записей не было"""
+        if self.last_record_at is None:
+            return None
+        return time.time() - self.last_record_at
+
+    async def _report(self, stage, message):
+        self.errors[stage] += 1
+        if stage not in self.recent_errors:
+            self.recent_errors[stage] = RateMeter(self.error_window)
+        self.recent_errors[stage].add()
+        logger.error(message)
+        if self.on_error is not None:
+            await self.on_error(stage, message)
+
+    async def _fetch(self, pages):
+        """Стадия чтения: нумерует страницы для упорядоченной фиксации курсора"""
+        seq = 0
+        while True:
+            try:
+                async for records, cursor in self.source.pages():
+                    await pages.put((seq, records, cursor))
+                    seq += 1
+                break
+            except Exception as e:
+                await self._report("fetch", f"Ошибка чтения логов: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+        # Источник исчерпан: каждому оценщику по сигналу завершения
+        for _ in range(self.scoring_workers):
+            await pages.put(None)
+
+    async def _score(self, pages, results):
+        """Стадия оценки страниц правилами и моделью"""
+        while True:
+            page = await pages.get()
+            if page is None:
+                await results.put(None)
+                return
+
+            seq, records, cursor = page
+            queries = [record.get('query', '') for record in records]
+            partitions = [(record.get('user', ''), record.get('database', '')) for record in records]
+            # Страница без вердиктов не уходит дальше: курсор не должен
+            # пройти мимо неоценённых записей, поэтому оценка повторяется
+            while True:
+                started = time.perf_counter()
+                try:
+                    verdicts = await self.score(queries, partitions)
+                    break
+                except Exception as e:
+                    await self._report("score", f"Ошибка оценки запросов: {e}")
+                    await asyncio.sleep(self.retry_delay)
+            STAGE_SECONDS.labels("score").observe(time.perf_counter() - started)
+            await results.put((seq, records, verdicts, cursor))
+
+    async def _alert(self, results):
+        """Стадия оповещений и фиксации курсора"""
+        finished = 0
+        done = {}
+        next_seq = 0
+        flushed_at = time.monotonic()
+        while finished < self.scoring_workers:
+            try:
+                item = await asyncio.wait_for(results.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                item = False
+            # Итоги подавленных повторов уходят по часам, а не только в паузах:
+            # под постоянной нагрузкой страницы приходят чаще flush_interval
+            if time.monotonic() - flushed_at >= self.flush_interval:
+                self._flush()
+                flushed_at = time.monotonic()
+            if item is False:
+                continue
+            if item is None:
+                finished += 1
+                continue
+
+            seq, records, verdicts, cursor = item
+            self._dispatch(records, verdicts)
+            if self.stats is not None:
+                self.stats.record(records, verdicts)
+            self.processed += len(records)
+            self.throughput.add(len(records))
+            QUERIES.inc(len(records))
+            if records:
+                self.last_timestamp = records[-1].get('@timestamp')
+                self.last_processed_at = time.time()
+                self.last_record_at = parse_timestamp(self.last_timestamp)
+
+            done[seq] = cursor
+            committed = None
+            while next_seq in done:
+                committed = done.pop(next_seq)
+                next_seq += 1
+            if committed is not None:
+                self.source.commit(committed)
+        self._flush()
+
+    def _dispatch(self, records, verdicts):
+        for record, verdict in zip(records, verdicts):
+            if not verdict.reason:
+                continue
+            self.anomalies += 1
+            ANOMALIES.labels(verdict.reason).inc()
+            key = (verdict.fingerprint, record.get('user'), verdict.reason)
+            alert_msg = self.deduplicator.admit(key, format_alert(record, verdict))
+            if alert_msg:
+                self.alert_queue.put(alert_msg)
+
+    def _flush(self):
+        for alert_msg in self.deduplicator.flush():
+            self.alert_queue.put(alert_msg)
@@ -0,0 +1,263 @@
+"""Прогон записанных логов через конвейер мониторинга без Elasticsearch и Telegram.
+
+Запуск:
+    python replay.py postgresql.log
+    python replay.py export.ndjson --speed 60 --model /var/lib/ml_monitor/model.joblib
+
+Записи проходят тот же путь, что и в main.py: Pipeline, Detector (или пул
+процессов), AlertDeduplicator и format_alert. Вместо Elasticsearch —
+файл, вместо очереди Telegram — локальный счётчик оповещений.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+from alerts import AlertDeduplicator
+from detector import Detector, ProcessPoolScorer, fit_models
+from features import FEATURE_MODES, FeatureSpace
+from log_tail import iter_entries, parse_entry
+from model_store import load_model, save_partitions
+from pipeline import Pipeline
+from query_cache import VerdictCache
+
+logger = logging.getLogger(__name__)
+
+
+def read_records(path):
+    """Записи из postgresql.log или NDJSON-выгрузки (документы или хиты с ``_source``)"""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        lines = f.read().splitlines()
+    if path.endswith(".log"):
+        records = (parse_entry(entry) for entry in iter_entries(lines))
+    else:
+        records = (json.loads(line) for line in lines if line.strip())
+        records = (record.get("_source", record) for record in records)
+    return [record for record in records if record and record.get("query")]
+
+
+def _epoch(timestamp):
+    """ISO-время записи в секундах или None, если его не разобрать"""
+    try:
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+class ReplaySource:
+    """Источник страниц из списка записей вместо EsLogSource.
+
+    При ``speed`` > 0 записи выдаются в темпе исходного лога, ускоренном
+    в ``speed`` раз; страница ограничена ``page_size`` записями и
+    ``poll_interval`` секундами, как при опросе индекса. При ``speed`` = 0 —
+    с максимальной скоростью. Курсор — число выданных записей.
+    """
+
+    def __init__(self, records, page_size=5000, speed=0.0, poll_interval=1.0):
+        self.records = records
+        self.page_size = page_size
+        self.speed = speed
+        self.poll_interval = poll_interval
+        self.committed = 0
+
+    async def pages(self):
+        """Страницы (записи, курсор) до конца списка"""
+        if not self.speed:
+            for start in range(0, len(self.records), self.page_size):
+                page = self.records[start:start + self.page_size]
+                yield page, start + len(page)
+                # Отдать управление остальным стадиям конвейера
+                await asyncio.sleep(0)
+            return
+
+        started = time.monotonic()
+        first = None
+        page = []
+        page_due = None
+        for position, record in enumerate(self.records, 1):
+            record_time = _epoch(record.get("@timestamp"))
+            if record_time is not None and first is None:
+                first = record_time
+            due = 0.0 if record_time is None else (record_time - first) / self.speed
+            if page and (len(page) >= self.page_size or due - page_due > self.poll_interval):
+                yield page, position - 1
+                page = []
+            if not page:
+                page_due = due
+                delay = started + due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            page.append(record)
+        if page:
+            yield page, len(self.records)
+
+    def commit(self, cursor):
+        self.committed = cursor
+
+
+class ReplayDeduplicator(AlertDeduplicator):
+    """Подавление повторов по времени записей, а не по часам прогона"""
+
+    def __init__(self, window=300, maxsize=100000):
+        super().__init__(window, maxsize)
+        self.now = 0.0
+
+    def admit(self, key, message, now=None):
+        return super().admit(key, message, self.now if now is None else now)
+
+    def flush(self, now=None):
+        return super().flush(self.now if now is None else now)
+
+
+class LocalAlertQueue:
+    """Замена AlertQueue: оповещения считаются и при желании пишутся в файл"""
+
+    def __init__(self, output=None):
+        self.output = output
+        self.messages = 0
+
+    def put(self, message):
+        self.messages += 1
+        if self.output is not None:
+            self.output.write(message + "\n\n")
+
+    def qsize(self):
+        return 0
+
+
+class ReplayPipeline(Pipeline):
+    """Pipeline с подсчётом срабатываний по причинам и часами по записям"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reasons = Counter()
+
+    def _dispatch(self, records, verdicts):
+        page_time = _epoch(records[-1].get("@timestamp")) if records else None
+        if page_time is not None:
+            self.deduplicator.now = page_time
+        self.reasons.update(verdict.reason for verdict in verdicts if verdict.reason)
+        super()._dispatch(records, verdicts)
+
+
+def _prepare_detector(args, records):
+    """Детектор с сохранённой моделью либо с моделью, обученной на выборке из прогона"""
+    detector = Detector(VerdictCache(maxsize=args.cache_size))
+    if args.model:
+        loaded = load_model(args.model)
+        if loaded is None:
+            raise SystemExit(f"Не удалось загрузить модель {args.model}")
+        model, metadata = loaded
+        detector.set_model(model, metadata)
+        print(f"Модель {metadata.get('version')} из {args.model}")
+        return detector
+
+    sample = records
+    if len(records) > args.train_size:
+        sample = random.Random(42).sample(records, args.train_size)
+    space = FeatureSpace(args.feature_mode, args.hash_width)
+    model, partition_models = fit_models(
+        [record["query"] for record in sample],
+        [(record.get("user", ""), record.get("database", "")) for record in sample],
+        args.partition_min_samples,
+        space=space
+    )
+    partitions_dir = tempfile.mkdtemp(prefix="replay_partitions_")
+    partitions = save_partitions(partitions_dir, partition_models)
+    detector.set_model(model, {
+        "version": "replay",
+        "partitions_dir": partitions_dir,
+        "partitions": partitions,
+        **space.metadata(),
+    })
+    print(f"Модель обучена на {len(sample)} записях прогона, разделов: {len(partitions)}")
+    return detector
+
+
+async def replay(args):
+    """Прогон файла через конвейер и отчёт о производительности и оповещениях"""
+    records = read_records(args.path)
+    print(f"Записей в {args.path}: {len(records)}")
+    detector = _prepare_detector(args, records)
+
+    score = detector.score_async
+    workers = args.workers
+    scorer = None
+    if args.processes:
+        scorer = ProcessPoolScorer(detector, args.processes)
+        score = scorer.score
+        workers = max(workers, args.processes)
+
+    async def report_error(stage, message):
+        print(f"Ошибка: {message}")
+
+    source = ReplaySource(records, args.page_size, args.speed)
+    deduplicator = ReplayDeduplicator(window=args.alert_window)
+    output = open(args.alerts_out, "w") if args.alerts_out else None
+    alert_queue = LocalAlertQueue(output)
+    pipeline = ReplayPipeline(
+        source, score, deduplicator, alert_queue,
+        scoring_workers=workers,
+        queue_size=args.queue_size,
+        on_error=report_error
+    )
+
+    started = time.perf_counter()
+    try:
+        await pipeline.run()
+    finally:
+        elapsed = time.perf_counter() - started
+        if scorer is not None:
+            scorer.close()
+        if output is not None:
+            output.close()
+
+    stats = detector.cache.stats()
+    print(f"Обработано: {pipeline.processed} записей за {elapsed:.2f} с "
+          f"({pipeline.processed / elapsed if elapsed else 0:.0f} запросов/с)")
+    print(f"Курсор зафиксирован на {source.committed} из {len(records)}")
+    print(f"Срабатываний: {pipeline.anomalies}")
+    for reason, count in pipeline.reasons.most_common():
+        print(f"  {reason}: {count}")
+    print(f"Оповещений: {alert_queue.messages}, подавлено повторов: {deduplicator.suppressed}")
+    if scorer is None:
+        print(f"Кэш вердиктов: попаданий {stats['hit_rate']:.1%}, записей {stats['size']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="postgresql.log или NDJSON-выгрузка")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="ускорение относительно времени записей; 0 — без пауз")
+    parser.add_argument("--page-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1, help="число оценщиков конвейера")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="оценка в пуле процессов; 0 — в цикле событий")
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--cache-size", type=int, default=10000)
+    parser.add_argument("--model", help="сохранённая модель main.py (MODEL_PATH)")
+    parser.add_argument("--train-size", type=int, default=200000,
+                        help="выборка для обучения, если --model не задан")
+    parser.add_argument("--partition-min-samples", type=int, default=1000)
+    parser.add_argument("--feature-mode", choices=FEATURE_MODES, default="basic",
+                        help="признаки модели, обучаемой на прогоне")
+    parser.add_argument("--hash-width", type=int, default=64)
+    parser.add_argument("--alert-window", type=int, default=300,
+                        help="окно подавления повторов, секунды времени записей")
+    parser.add_argument("--alerts-out", help="файл для текстов оповещений")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main()
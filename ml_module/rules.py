@@ -0,0 +1,33 @@
+import re
+
+# Правила проверяются по нормализованному тексту sql_lexer.tokenize:
+# нижний регистр, один пробел между лексемами, литералы заменены на ?
+DANGEROUS_PATTERNS = {
+    "drop_database": r'drop\s+database',
+    "truncate_table": r'truncate\s+table',
+    "delete_from": r'delete\s+from\s+\w+\s*(?!where)',
+    "alter_table_drop": r'alter\s+table\s+\w+\s+drop',
+    "semicolon_comment": r';\s*--',
+    "tautology": r'1\s*=\s*1',
+    "union_select": r'union\s+select',
+    "insert_values": r'insert\s+into\s+\w+\s+values',
+    "update_set": r'update\s+\w+\s+set\s+\w+\s*=\s*[\w?]+\s*(?!where)',
+}
+
+# Все правила одним выражением: именованная группа на правило
+RULES_RE = re.compile("|".join(
+    f"(?P<{name}>{pattern})" for name, pattern in DANGEROUS_PATTERNS.items()
+))
+# Та же альтернатива без групп: re строит по ней префильтр первых символов,
+# который именованные группы отключают, поэтому поиск идёт по ней
+_ANY_RULE_RE = re.compile("|".join(
+    f"(?:{pattern})" for pattern in DANGEROUS_PATTERNS.values()
+))
+
+
+def match_rule(text):
+    """Имя первого сработавшего правила или None"""
+    match = _ANY_RULE_RE.search(text)
+    if match is None:
+        return None
+    return RULES_RE.match(text, match.start()).lastgroup
@@ -0,0 +1,120 @@
+import hashlib
+import re
+from collections import Counter, namedtuple
+
+SqlTokens = namedtuple(
+    "SqlTokens",
+    "length keywords comments literals statements semicolon_comments tokens text"
+)
+
+KEYWORDS = frozenset((
+    "select", "insert", "update", "delete", "from", "where", "join", "union",
+    "into", "values", "set", "drop", "truncate", "alter", "create", "table",
+    "database", "grant", "revoke", "and", "or", "not", "having", "group",
+    "order", "by", "limit", "offset", "exec", "execute", "copy",
+))
+
+COMMENT_MARKER = "--"
+LITERAL_MARKER = "?"
+# Временная метка правого литерала в сравнении двух одинаковых литералов
+_TAUTOLOGY_MARKER = "\x00"
+
+# Лексемы, которые нормализация заменяет или пропускает целиком. Выражение
+# начинается с класса первых символов, поэтому re проверяет только эти
+# позиции, а вид лексемы уточняет ретроспективная проверка первого символа;
+# слова и операторы копируются как есть. Незакрытые блочный комментарий и
+# строка в долларовых кавычках продолжаются до конца текста, как в
+# PostgreSQL, иначе каждый незакрытый /* заново просматривал бы остаток запроса
+_NORMALIZE_RE = re.compile(r"""
+    [-/'$".\d]
+    (?:
+        (?<=-)-[^\n]*                           # однострочный комментарий
+      | (?<=/)\*(?:.*?\*/|.*)                   # блочный комментарий
+      | (?<=')(?:[^']|'')*'                     # строка
+      | (?<=\$)\$(?:.*?\$\$|.*)                 # строка в долларовых кавычках
+      | (?<=\$)\d+                              # параметр
+      | (?<=")(?:[^"]|"")*"                     # идентификатор в кавычках
+      | (?<=\d)(?<!\w\d)\d*(?:\.\d*)?(?:[eE][+-]?\d+)?      # число, но не цифры слова
+      | (?<=\.)\d+(?:[eE][+-]?\d+)?
+    )
+""", re.S | re.X)
+_TAUTOLOGY_RE = re.compile(r"\?\s*=\s*" + _TAUTOLOGY_MARKER)
+# Лексемы нормализованного текста: литералов и комментариев в нём уже нет
+_TOKEN_RE = re.compile(r'\w+|"(?:[^"]|"")*"|--|[<>=!]=|<>|::|\|\||\S')
+# Списки литералов IN (?, ?, ?) сворачиваются, чтобы длина списка не меняла отпечаток
+_LITERAL_LIST_RE = re.compile(r'\( \?(?: , \?)+ \)')
+
+
+def normalize(query):
+    """Текст запроса в нижнем регистре с литералами и параметрами, заменёнными
+    на ``?``, и комментариями, заменёнными на ``--``. Сравнение двух
+    одинаковых литералов (``1=1``, ``'a'='a'``) сохраняется как ``1 = 1``,
+    чтобы правила видели тавтологию. Пробелы не сжимаются.
+    """
+    previous = None
+
+    def replace(match):
+        nonlocal previous
+        lexeme = match.group()
+        first = lexeme[0]
+        if first == '"':
+            # Совпадает целиком, чтобы кавычка или -- внутри не читались как лексема
+            return lexeme
+        if first == "-" or first == "/":
+            return f" {COMMENT_MARKER} "
+        if (previous is not None and previous[0] == lexeme
+                and query[previous[1]:match.start()].strip() == "="):
+            previous = None
+            return f" {_TAUTOLOGY_MARKER} "
+        previous = (lexeme, match.end())
+        return f" {LITERAL_MARKER} "
+
+    normalized = _NORMALIZE_RE.sub(replace, query)
+    if _TAUTOLOGY_MARKER in normalized:
+        normalized = _TAUTOLOGY_RE.sub("1 = 1", normalized)
+    return normalized.lower()
+
+
+def tokenize(query, normalized=None):
+    """Разбор запроса по результату normalize (``normalized``, если он уже
+    посчитан). В ``text`` лексемы разделены одним пробелом; ``literals``
+    считает литералы и параметры.
+    """
+    if normalized is None:
+        normalized = normalize(query)
+    tokens = _TOKEN_RE.findall(normalized)
+    counts = Counter(tokens)
+    keywords = Counter({word: counts[word] for word in KEYWORDS.intersection(counts)})
+    statements = semicolon_comments = 0
+    if ";" not in counts:
+        statements = int(len(tokens) > counts[COMMENT_MARKER])
+    else:
+        # Границы операторов проходятся по лексемам только в запросах с ;
+        statement_open = False
+        previous = None
+        for token in tokens:
+            if token == ";":
+                statement_open = False
+            elif token == COMMENT_MARKER:
+                semicolon_comments += previous == ";"
+            elif not statement_open:
+                statements += 1
+                statement_open = True
+            previous = token
+    return SqlTokens(
+        len(query), keywords, counts[COMMENT_MARKER],
+        counts[LITERAL_MARKER] + counts["1"], statements,
+        semicolon_comments, tokens, " ".join(tokens)
+    )
+
+
+def fingerprint(normalized):
+    """Отпечаток запроса в духе pg_stat_statements: 64-битный хеш
+    результата normalize со сжатыми пробелами.
+
+    Маркеры комментариев и тавтологий остаются в тексте, поэтому правила
+    дают один и тот же вердикт для всех запросов с одним отпечатком, а
+    проверка кэша не требует разбора на лексемы.
+    """
+    text = _LITERAL_LIST_RE.sub("( ? )", " ".join(normalized.split()))
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
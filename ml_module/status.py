@@ -0,0 +1,103 @@
+"""Состояние мониторинга для бота через Unix-сокет.
+
+Мониторинг отвечает на строку-команду одним JSON-объектом и закрывает
+соединение. Ответ собирается в цикле событий мониторинга из уже
+посчитанных счётчиков, поэтому блокировки не нужны, а Elasticsearch
+не затрагивается.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateMeter:
+    """Скорость событий за последние ``window`` секунд: кольцо посекундных корзин"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self._counts = [0] * window
+        self._seconds = [0] * window
+
+    def add(self, count=1, now=None):
+        second = int(time.time() if now is None else now)
+        slot = second % self.window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += count
+
+    def count(self, now=None):
+        """Событий за окно"""
+        second = int(time.time() if now is None else now)
+        return sum(
+            count for count, bucket in zip(self._counts, self._seconds)
+            if second - bucket < self.window
+        )
+
+    def rate(self, now=None):
+        """Событий в секунду в среднем по окну"""
+        return self.count(now) / self.window
+
+
+class StatusServer:
+    """Unix-сокет с командами: имя -> функция(аргументы) с JSON-совместимым ответом.
+
+    ValueError из функции возвращается клиенту как ``{"error": ...}``.
+    """
+
+    def __init__(self, path, handlers):
+        self.path = path
+        self.handlers = handlers
+        self._server = None
+
+    async def start(self):
+        """Запуск в текущем цикле событий; сокет от прошлого запуска удаляется"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+        logger.info(f"Состояние мониторинга доступно через {self.path}")
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            command, *args = line.decode("utf-8", "replace").split() or [""]
+            handler = self.handlers.get(command)
+            if handler is None:
+                response = {"error": f"неизвестная команда: {command}"}
+            else:
+                try:
+                    response = handler(args)
+                except ValueError as e:
+                    response = {"error": str(e)}
+            writer.write(json.dumps(response, ensure_ascii=False, default=str).encode() + b"\n")
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса состояния: {e}")
+        finally:
+            writer.close()
+
+
+async def query_status(path, command="status", timeout=2.0):
+    """Ответ мониторинга на команду; исключение, если мониторинг не отвечает"""
+    async def request():
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            writer.write(command.encode() + b"\n")
+            await writer.drain()
+            return json.loads(await reader.readline())
+        finally:
+            writer.close()
+
+    return await asyncio.wait_for(request(), timeout=timeout)